@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+
+# Boot a kernel and (concatenated) initramfs images created by
+# mkrescuenet.py with QEMU and measure how long it takes until the
+# image is unpacked, systemd reaches multi-user.target, the network
+# is online and sshd accepts connections.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-FileCopyrightText: © 2021 Georg Sauthoff <mail@gms.tf>
+
+import argparse
+import json
+import os
+import re
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def mk_arg_parser():
+    p = argparse.ArgumentParser(
+            description=('Measure the boot time of a rescue image under QEMU,'
+                ' i.e. until the initramfs is unpacked, multi-user.target is'
+                ' reached, the network is online and sshd sends its banner'),
+            epilog=('Multiple INITRD images are concatenated, e.g.'
+                ' f34.cpio.xz f34-storage.cpio.xz config-f34.cpio.xz'))
+    p.add_argument('kernel', metavar='VMLINUZ', help='kernel image')
+    p.add_argument('initrds', nargs='+', metavar='INITRD', help='initramfs images')
+    p.add_argument('--runs', '-n', type=int, default=3,
+            help='number of boots (default: %(default)d)')
+    p.add_argument('--accel', choices=[ 'auto', 'kvm', 'tcg' ], default='auto',
+            help=('QEMU accelerator, auto selects KVM if /dev/kvm is accessible'
+                ' (default: %(default)s)'))
+    p.add_argument('--memory', '-m', default='2G',
+            help='guest RAM (default: %(default)s)')
+    p.add_argument('--smp', type=int, default=2,
+            help='number of guest CPUs (default: %(default)d)')
+    p.add_argument('--port', type=int, default=0,
+            help=('host port that is forwarded to the guest\'s ssh port'
+                ' (default: a free one)'))
+    p.add_argument('--append', default='',
+            help='additional kernel parameters')
+    p.add_argument('--qemu', default='qemu-system-x86_64',
+            help='QEMU command (default: %(default)s)')
+    p.add_argument('--timeout', type=float, default=300,
+            help='maximum seconds per boot (default: %(default)s)')
+    p.add_argument('--log', metavar='PREFIX',
+            help='write the serial console output of each run to PREFIX-N.log')
+    p.add_argument('--json', metavar='FILE',
+            help='write the timestamps of all runs to FILE, e.g. for comparisons')
+    return p
+
+def parse_args(*a):
+    args = mk_arg_parser().parse_args(*a)
+    if args.runs < 1:
+        raise RuntimeError('--runs must be at least 1')
+    if args.accel == 'auto':
+        args.accel = 'kvm' if os.access('/dev/kvm', os.R_OK | os.W_OK) else 'tcg'
+    return args
+
+
+# Boot milestones as printed on the serial console (by the kernel and
+# systemd), in the order they are expected.
+events = [
+        ('kernel',      re.compile(r'Linux version ')),
+        ('unpacked',    re.compile(r'Freeing initrd memory')),
+        ('systemd',     re.compile(r'systemd.* running in system mode')),
+        ('multi-user',  re.compile(r'Reached target.*(multi-user\.target|Multi-User System)')),
+        ('wait-online', re.compile(r'(Finished|Started).*(systemd-networkd-wait-online'
+                                   r'|Wait for Network to be Configured)')),
+        ]
+ssh_event = 'ssh'
+
+# i.e. systemd colors its status messages
+ansi_escape = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+def match_event(line):
+    line = ansi_escape.sub('', line)
+    for name, r in events:
+        if r.search(line):
+            return name
+    return None
+
+def test_match_event():
+    assert match_event('[    0.000000] Linux version 5.14.10-300.fc35.x86_64') == 'kernel'
+    assert match_event('[    1.51] Freeing initrd memory: 112648K') == 'unpacked'
+    assert match_event('[    2.1] systemd[1]: systemd v248.7-1.fc34 running in'
+            ' system mode (+PAM +AUDIT)') == 'systemd'
+    assert match_event('[\x1b[0;32m  OK  \x1b[0m] Reached target'
+            ' \x1b[0;1;39mMulti-User System\x1b[0m.') == 'multi-user'
+    assert match_event('[  OK  ] Reached target multi-user.target - Multi-User System.'
+            ) == 'multi-user'
+    assert match_event('[  OK  ] Finished systemd-networkd-wait-online.service'
+            ' - Wait for Network to be Configured.') == 'wait-online'
+    assert match_event('[  OK  ] Started Wait for Network to be Configured.'
+            ) == 'wait-online'
+    assert match_event('[  OK  ] Reached target Network.') is None
+
+# NB: with user-mode networking, QEMU accepts the connection even if
+# nothing listens inside the guest (and then closes it), thus only the
+# banner counts.
+def ssh_banner(port, timeout=1):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=timeout) as s:
+            return s.recv(64).startswith(b'SSH-')
+    except OSError:
+        return False
+
+def test_ssh_banner():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        s.listen()
+        port = s.getsockname()[1]
+        def serve():
+            for banner in (b'', b'SSH-2.0-OpenSSH_8.6\r\n'):
+                c, _ = s.accept()
+                c.sendall(banner)
+                c.close()
+        t = threading.Thread(target=serve)
+        t.start()
+        assert not ssh_banner(port)
+        assert ssh_banner(port)
+        t.join()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# i.e. the kernel expects each (compressed) archive 4 byte aligned and
+# skips the NUL padding
+def concat_initrds(filenames, out):
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            b = f.read()
+        out.write(b)
+        out.write(b'\0' * (-len(b) & 3))
+    out.flush()
+
+def qemu_cmd(args, initrd, port):
+    c = [ args.qemu, '-nodefaults', '-no-reboot', '-display', 'none',
+          '-serial', 'stdio', '-m', args.memory, '-smp', str(args.smp),
+          '-netdev', f'user,hostfwd=tcp:127.0.0.1:{port}-:22,id=n1',
+          '-device', 'virtio-net,netdev=n1', '-device', 'virtio-rng-pci',
+          '-kernel', args.kernel, '-initrd', initrd,
+          '-append', f'console=ttyS0,115200 {args.append}'.strip() ]
+    if args.accel == 'kvm':
+        c += [ '-accel', 'kvm', '-cpu', 'host' ]
+    else:
+        c += [ '-accel', 'tcg', '-cpu', 'max' ]
+    return c
+
+# Boots once and returns the seconds (since starting QEMU) of each
+# milestone, where the ones that weren't observed are missing.
+def boot(args, initrd, log=None, grace=5):
+    port = args.port or free_port()
+    ts = {}
+    t0 = time.monotonic()
+    p = subprocess.Popen(qemu_cmd(args, initrd, port), stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    timer = threading.Timer(args.timeout, p.kill)
+    timer.start()
+
+    def probe():
+        while p.poll() is None:
+            if ssh_banner(port):
+                ts[ssh_event] = time.monotonic() - t0
+                break
+            time.sleep(0.1)
+        # i.e. give the console some time for the remaining milestones
+        deadline = time.monotonic() + grace
+        while p.poll() is None and time.monotonic() < deadline:
+            if all(name in ts for name, _ in events):
+                break
+            time.sleep(0.1)
+        p.terminate()
+
+    prober = threading.Thread(target=probe)
+    prober.start()
+    try:
+        for line in p.stdout:
+            t = time.monotonic() - t0
+            line = line.decode(errors='replace')
+            if log:
+                log.write(f'{t:9.3f} {line}')
+            name = match_event(line)
+            if name and name not in ts:
+                ts[name] = t
+    finally:
+        prober.join()
+        timer.cancel()
+        p.wait()
+    if ssh_event not in ts and time.monotonic() - t0 >= args.timeout:
+        print(f'Timeout after {args.timeout} s', file=sys.stderr)
+    return ts
+
+def print_summary(runs):
+    names = [ name for name, _ in events ] + [ ssh_event ]
+    print(f'\n{"Milestone":12} {"Min":>8} {"Median":>8} {"Max":>8} {"Runs":>5}')
+    for name in names:
+        xs = [ r[name] for r in runs if name in r ]
+        if not xs:
+            print(f'{name:12} {"-":>8} {"-":>8} {"-":>8} {0:5}')
+            continue
+        print(f'{name:12} {min(xs):7.2f}s {statistics.median(xs):7.2f}s'
+                f' {max(xs):7.2f}s {len(xs):5}')
+
+
+def main():
+    args = parse_args()
+    runs = []
+    with tempfile.NamedTemporaryFile(prefix='bootbench-', suffix='.cpio') as f:
+        concat_initrds(args.initrds, f)
+        print(f'Booting {args.kernel} with {" ".join(args.initrds)}'
+                f' ({args.accel}, {args.memory} RAM, {args.runs} runs)')
+        print(' '.join(shlex.quote(x) for x in qemu_cmd(args, f.name, args.port or 'PORT')))
+        for i in range(args.runs):
+            if args.log:
+                with open(f'{args.log}-{i + 1}.log', 'w') as log:
+                    ts = boot(args, f.name, log)
+            else:
+                ts = boot(args, f.name)
+            runs.append(ts)
+            print(f'Run {i + 1}: ' + ', '.join(f'{k} {v:.2f}s' for k, v in
+                sorted(ts.items(), key=lambda x: x[1])))
+    print_summary(runs)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({ 'kernel': args.kernel, 'initrds': args.initrds,
+                'accel': args.accel, 'memory': args.memory, 'runs': runs }, f,
+                indent=1)
+    if not any(ssh_event in r for r in runs):
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+# Copy files (such as initramfs images and kernels) to a remote
+# directory by just transferring the chunks that aren't already
+# present in the old version of a file on the remote side.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-FileCopyrightText: © 2021 Georg Sauthoff <mail@gms.tf>
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import zlib
+
+
+def mk_arg_parser():
+    p = argparse.ArgumentParser(
+            description=('Copy files to a remote directory by just sending the'
+                ' (content-defined) chunks that changed'),
+            epilog=('TARGET is either HOST:DIR (via ssh) or a local directory.'
+                ' The remote side only requires python3.'))
+    p.add_argument('files', nargs='+', metavar='FILE', help='files to copy')
+    p.add_argument('target', metavar='TARGET', help='destination directory')
+    p.add_argument('--basis', action='append', default=[],
+            help=('additional remote file (relative to TARGET) whose chunks can'
+                ' be reused, e.g. the image of the previous release'
+                ' (can be specified multiple times)'))
+    p.add_argument('--chunk-size', type=int, default=64*1024,
+            help='average chunk size, a power of two (default: %(default)d)')
+    p.add_argument('--ssh', default='ssh',
+            help='ssh command, e.g. "ssh -p 2222" (default: %(default)s)')
+    p.add_argument('--python', default='python3',
+            help='remote python interpreter (default: %(default)s)')
+    return p
+
+def parse_args(*a):
+    args = mk_arg_parser().parse_args(*a)
+    if args.chunk_size < 1024 or args.chunk_size & (args.chunk_size - 1):
+        raise RuntimeError('--chunk-size must be a power of two >= 1024')
+    return args
+
+
+# Content-defined chunking, i.e. the chunk boundaries only depend on
+# the local content such that they re-synchronize after inserted or
+# removed bytes. In order to avoid a (slow) per-byte loop in Python,
+# only the positions of some anchor bytes (found with C speed) are
+# candidates for a boundary. A candidate is a boundary if the hash
+# of the preceding window has its low bits unset. The anchors are
+# common in text, x86 code and compressed data.
+anchors = re.compile(rb'[\n\x48\x8fe]')
+window  = 32
+
+# yields: (offset, size)
+def chunk_bounds(b, avg=64*1024):
+    n    = len(b)
+    lo   = max(avg // 4, window)
+    hi   = avg * 4
+    # i.e. random data has 4 anchors per 256 bytes, thus a boundary
+    # is found after about avg/2 bytes, on average
+    mask = avg // 128 - 1
+    start = 0
+    while start < n:
+        end = min(start + hi, n)
+        cut = end
+        for m in anchors.finditer(b, start + lo, end):
+            i = m.start()
+            if not zlib.crc32(b[i - window:i]) & mask:
+                cut = i
+                break
+        yield start, cut - start
+        start = cut
+
+def chunk_digest(b):
+    return hashlib.blake2b(b, digest_size=16).hexdigest()
+
+# returns: [ (digest, offset, size) ]
+def chunk_sums(b, avg=64*1024):
+    return [ (chunk_digest(b[off:off+k]), off, k) for off, k in chunk_bounds(b, avg) ]
+
+def map_file(f):
+    if not os.fstat(f.fileno()).st_size:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# Messages are a JSON header line followed by n bytes of payload.
+def send(f, h, data=b''):
+    h = dict(h, n=len(data))
+    f.write(json.dumps(h).encode() + b'\n')
+    f.write(data)
+    f.flush()
+
+def recv(f):
+    line = f.readline()
+    if not line:
+        raise EOFError('connection closed')
+    h = json.loads(line)
+    data = f.read(h['n'])
+    if len(data) != h['n']:
+        raise EOFError('connection closed')
+    return h, data
+
+
+# Remote side, i.e. this file is sent to and executed by the bootstrap.
+def agent_sums(h):
+    xs = []
+    for i, path in enumerate(h['basis']):
+        try:
+            with open(path, 'rb') as f:
+                b = map_file(f)
+                xs.extend((d, i, off, k) for d, off, k in chunk_sums(b, h['avg']))
+        except FileNotFoundError:
+            pass
+    return { 'chunks': xs }
+
+# Writes the new file from copy/data ops into a temporary file which
+# atomically replaces the destination once its digest checks out.
+def agent_patch(h, data):
+    path = h['path']
+    fs = []
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+            prefix='.' + os.path.basename(path) + '.')
+    try:
+        with open(fd, 'wb') as g:
+            fs = [ open(x, 'rb') if os.path.exists(x) else None
+                    for x in h['basis'] ]
+            d = hashlib.sha256()
+            off = 0
+            for op in h['ops']:
+                if op[0] == 'copy':
+                    _, i, pos, k = op
+                    fs[i].seek(pos)
+                    b = fs[i].read(k)
+                else:
+                    k = op[1]
+                    b = data[off:off+k]
+                    off += k
+                d.update(b)
+                g.write(b)
+            if d.hexdigest() != h['sha256']:
+                raise RuntimeError(f'{path}: checksum mismatch')
+            g.flush()
+            os.fsync(g.fileno())
+        os.chmod(tmp, h['mode'])
+        os.utime(tmp, ns=(h['mtime'], h['mtime']))
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    finally:
+        for f in fs:
+            if f:
+                f.close()
+    return { 'ok': True }
+
+def agent(i, o):
+    while True:
+        try:
+            h, data = recv(i)
+        except EOFError:
+            return
+        if h['op'] == 'quit':
+            return
+        try:
+            if h['op'] == 'sums':
+                r = agent_sums(h)
+            elif h['op'] == 'patch':
+                r = agent_patch(h, data)
+            else:
+                r = { 'error': f'unknown op: {h["op"]}' }
+        except Exception as e:
+            r = { 'error': str(e) }
+        send(o, r)
+
+
+# Starts the agent on the remote side, i.e. the transport only has to
+# run a command whose stdin/stdout are connected to us.
+bootstrap = ('import sys;i=sys.stdin.buffer;g={"__name__":"deltacp"};'
+        'exec(i.read(int(i.readline())),g);g["agent"](i,sys.stdout.buffer)')
+
+def transport_cmd(target, args):
+    host, sep, path = target.partition(':')
+    if sep and '/' not in host:
+        return (shlex.split(args.ssh) + [ host,
+            f'{args.python} -c {shlex.quote(bootstrap)}' ]), path or '.'
+    return [ sys.executable, '-c', bootstrap ], target
+
+class Remote:
+    def __init__(self, cmd):
+        self.p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        with open(__file__, 'rb') as f:
+            src = f.read()
+        self.p.stdin.write(b'%d\n' % len(src) + src)
+
+    def call(self, h, data=b''):
+        send(self.p.stdin, h, data)
+        r, _ = recv(self.p.stdout)
+        if 'error' in r:
+            raise RuntimeError(f'remote: {r["error"]}')
+        return r
+
+    def close(self):
+        send(self.p.stdin, { 'op': 'quit' })
+        self.p.stdin.close()
+        if self.p.wait():
+            raise RuntimeError(f'transport failed: {self.p.returncode}')
+
+
+# returns: (ops, literal data), where adjacent copies are merged
+def mk_ops(b, chunks, avg):
+    have = { d: (i, off, k) for d, i, off, k in chunks }
+    ops  = []
+    data = []
+    for off, k in chunk_bounds(b, avg):
+        c = have.get(chunk_digest(b[off:off+k]))
+        if c:
+            last = ops[-1] if ops else None
+            if (last and last[0] == 'copy' and last[1] == c[0]
+                    and last[2] + last[3] == c[1]):
+                last[3] += k
+            else:
+                ops.append([ 'copy', c[0], c[1], k ])
+        else:
+            data.append(b[off:off+k])
+            if ops and ops[-1][0] == 'data':
+                ops[-1][1] += k
+            else:
+                ops.append([ 'data', k ])
+    return ops, b''.join(data)
+
+def copy_file(remote, filename, path, basis=(), avg=64*1024):
+    basis = [ path ] + list(basis)
+    r = remote.call({ 'op': 'sums', 'basis': basis, 'avg': avg })
+    with open(filename, 'rb') as f:
+        st = os.fstat(f.fileno())
+        b = map_file(f)
+        ops, data = mk_ops(b, r['chunks'], avg)
+        remote.call({ 'op': 'patch', 'path': path, 'basis': basis, 'ops': ops,
+            'sha256': hashlib.sha256(b).hexdigest(),
+            'mode': st.st_mode & 0o7777, 'mtime': st.st_mtime_ns }, data)
+    return len(data), st.st_size
+
+def test_copy_local():
+    with tempfile.TemporaryDirectory() as d:
+        os.mkdir(d + '/remote')
+        old = os.urandom(256 * 1024)
+        with open(d + '/remote/img', 'wb') as f:
+            f.write(old)
+        new = old[:1000] + b'inserted' + old[1000:100000] + old[110000:]
+        with open(d + '/img', 'wb') as f:
+            f.write(new)
+        args = parse_args([ d + '/img', d + '/remote' ])
+        cmd, rdir = transport_cmd(args.target, args)
+        remote = Remote(cmd)
+        sent, total = copy_file(remote, d + '/img', rdir + '/img', avg=4096)
+        sent2, _ = copy_file(remote, d + '/img', rdir + '/img2', [ rdir + '/img' ],
+                avg=4096)
+        remote.close()
+        with open(d + '/remote/img', 'rb') as f:
+            assert f.read() == new
+        with open(d + '/remote/img2', 'rb') as f:
+            assert f.read() == new
+        assert sent < total // 4
+        assert sent2 == 0
+        assert sorted(os.listdir(d + '/remote')) == [ 'img', 'img2' ]
+
+
+def main():
+    args = parse_args()
+    cmd, rdir = transport_cmd(args.target, args)
+    remote = Remote(cmd)
+    for filename in args.files:
+        path = f'{rdir}/{os.path.basename(filename)}'
+        basis = [ f'{rdir}/{x}' for x in args.basis ]
+        sent, total = copy_file(remote, filename, path, basis, args.chunk_size)
+        print(f'{filename}: sent {sent} of {total} bytes'
+                f' ({100 * sent / max(total, 1):.1f} %)')
+    remote.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,12 +4,125 @@
 # SPDX-FileCopyrightText: © 2020 Georg Sauthoff <mail@gms.tf>
 
 import argparse
+import base64
+import bisect
+import concurrent.futures
+import configparser
+import contextlib
+import fcntl
+import fnmatch
+import functools
 import glob
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
+import multiprocessing
 import os
+import re
+import resource
+import shlex
 import shutil
 import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import time
+
+
+phases = []
+# i.e. the peak RSS of the active (possibly nested) phases, cf. profiled()
+phase_peaks = []
+
+def io_counters():
+    d = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                k, v = line.split(':')
+                d[k] = int(v)
+    except OSError:
+        pass
+    return d
+
+# NB: the peak RSS (VmHWM) of the process is reset, after accounting it
+# to the active phases, such that the next snapshot yields the peak RSS
+# since this one
+def resource_snapshot():
+    hwm = read_hwm('self')
+    phase_peaks[:] = [ max(x, hwm) for x in phase_peaks ]
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    return (time.time(), time.perf_counter(),
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN), io_counters())
+
+# NB: /proc/self/io also accounts for the I/O of waited-for children,
+# the ru_maxrss of children is the peak over the lifetime of the
+# biggest child (i.e. not necessarily one of this phase)
+def phase_record(name, a, b, peak=0):
+    t0, p0, s0, c0, io0 = a
+    t1, p1, s1, c1, io1 = b
+    return { 'name': name, 'pid': os.getpid(), 'start': t0, 'wall': p1 - p0,
+        'cpu': s1.ru_utime - s0.ru_utime + s1.ru_stime - s0.ru_stime,
+        'children_cpu': (c1.ru_utime - c0.ru_utime + c1.ru_stime - c0.ru_stime),
+        'read_bytes':  io1.get('read_bytes', 0)  - io0.get('read_bytes', 0),
+        'write_bytes': io1.get('write_bytes', 0) - io0.get('write_bytes', 0),
+        'rchar': io1.get('rchar', 0) - io0.get('rchar', 0),
+        'wchar': io1.get('wchar', 0) - io0.get('wchar', 0),
+        'maxrss_kb': peak // 1024 if peak else s1.ru_maxrss,
+        'children_maxrss_kb': c1.ru_maxrss }
+
+# records wall/CPU time, I/O and peak RSS of a build phase, cf. --profile
+def profiled(fn):
+    @functools.wraps(fn)
+    def f(*xs, **ys):
+        a = resource_snapshot()
+        phase_peaks.append(0)
+        try:
+            return fn(*xs, **ys)
+        finally:
+            b = resource_snapshot()
+            phases.append(phase_record(fn.__name__, a, b, phase_peaks.pop()))
+    return f
+
+def write_profile(filename, trace=False):
+    if trace:
+        # Chrome trace event format, cf. chrome://tracing or ui.perfetto.dev
+        # i.e. phases of --matrix workers have their own pid
+        d = { 'traceEvents': [ { 'name': x['name'], 'ph': 'X', 'pid': x['pid'],
+            'tid': 0, 'ts': int(x['start'] * 1e6), 'dur': int(x['wall'] * 1e6),
+            'args': { k: v for k, v in x.items() if k not in ('name', 'pid', 'start') } }
+            for x in phases ] }
+    else:
+        d = { 'phases': phases }
+    with open(filename, 'w') as f:
+        json.dump(d, f, indent=1)
+
+def test_profiled():
+    @profiled
+    def inner():
+        pass
+    @profiled
+    def outer():
+        x = bytearray(64 * 1024 * 1024)
+        x[::4096] = b'x' * len(x[::4096])
+        del x
+        inner()
+    n = len(phases)
+    outer()
+    i, o = phases[n:]
+    del phases[n:]
+    assert (i['name'], o['name']) == ('inner', 'outer')
+    # i.e. the peak of the outer phase isn't reset by the inner one
+    assert o['maxrss_kb'] - i['maxrss_kb'] > 32 * 1024
 
 
 def mk_arg_parser():
@@ -36,6 +149,133 @@ def mk_arg_parser():
             help='Use gzip compression (default: xz)')
     p.add_argument('--none', dest='compress', const='', nargs='?',
             help='Use no compression (default: xz)')
+    p.add_argument('--zstd', dest='compress', const='zst', nargs='?',
+            help='Use zstd compression (default: xz), requires CONFIG_RD_ZSTD')
+    p.add_argument('--lz4', dest='compress', const='lz4', nargs='?',
+            help='Use lz4 compression (default: xz), requires CONFIG_RD_LZ4')
+    p.add_argument('--layout', choices=['cpio', 'squashfs', 'erofs'], default='cpio',
+            help=('cpio: unpack the complete tree into RAM, squashfs/erofs: just'
+                ' include an init shim and a compressed root image that is'
+                ' mounted with a tmpfs overlay (default: %(default)s)'))
+    p.add_argument('--features', metavar='FEATURES', type=lambda s: s.split(','),
+            default=[],
+            help=('comma separated list of features that are archived into'
+                ' separate images (that can be appended when booting),'
+                f' available: {",".join(feature_segments)}'))
+    p.add_argument('--threads', '-T', type=int, default=0,
+            help='compression threads (default: 0, i.e. all cores)')
+    p.add_argument('--block-size',
+            help=('xz block size for multi-threaded compression, e.g. 16MiB'
+                ' (default: 3 times the dictionary size)'))
+    p.add_argument('--seekable', action='store_true',
+            help=('compress the image in independent blocks (xz or zstd, cf.'
+                ' --seekable-block-size) and write an index next to it,'
+                ' i.e. for --list-image and --extract-image'))
+    p.add_argument('--seekable-block-size', metavar='SIZE',
+            help=('uncompressed size of the blocks of a --seekable image, where'
+                ' blocks start at archive entry boundaries (default: 4MiB)'))
+    p.add_argument('--list-image', metavar='IMAGE',
+            help='list the contents of a --seekable image (via its index)')
+    p.add_argument('--extract-image', metavar='IMAGE',
+            help=('extract files from a --seekable image, i.e. just the blocks'
+                ' that contain them are decompressed (cf. --extract)'))
+    p.add_argument('--extract', dest='extract_paths', metavar='GLOB',
+            action='append',
+            help=('path to extract with --extract-image, may contain wildcards'
+                ' (default: all, can be specified multiple times)'))
+    p.add_argument('--extract-dir', default='.',
+            help='destination directory for --extract-image (default: %(default)s)')
+    p.add_argument('--reproducible', action='store_true',
+            help=('create byte-identical images from identical trees, i.e. sorted'
+                ' entries, normalized inode/device numbers, mtimes clamped to'
+                ' $SOURCE_DATE_EPOCH (default: 0) and a deterministic'
+                ' compressor configuration'))
+    p.add_argument('--cache', metavar='DIR',
+            help=('archive the tree as separately compressed segments cached'
+                ' in DIR, i.e. rebuilds only recompress changed segments'))
+    p.add_argument('--dedup', action='store_true',
+            help=('archive files with identical content (and metadata) as'
+                ' hardlinks, i.e. store and unpack them just once'))
+    p.add_argument('--order', choices=[ 'tree', 'type' ], default='tree',
+            help=('order of the archive entries, i.e. type groups files by type'
+                ' and extension which improves the compression ratio'
+                ' (default: %(default)s)'))
+    p.add_argument('--debloat', metavar='CLASSES', nargs='?',
+            const=','.join(debloat_classes), type=lambda s: s.split(','),
+            help=('remove debris from the tree, i.e. a comma separated list of'
+                f' {",".join(debloat_classes)} (default: all of them),'
+                ' where debug strips executables and libraries'))
+    p.add_argument('--exclude', '-x', action='append', default=[],
+            help=('exclude a path from the image, may contain wildcards,'
+                ' a trailing slash excludes just the directory contents'
+                ' (can be specified multiple times)'))
+    p.add_argument('--analyze', action='store_true',
+            help=('report the uncompressed and estimated compressed size of the'
+                ' tree per directory, package and file type'))
+    p.add_argument('--depth', type=int, default=3,
+            help='directory depth for --analyze (default: %(default)s)')
+    p.add_argument('--report', metavar='JSON',
+            help='store the --analyze report in a file')
+    p.add_argument('--diff', metavar='JSON',
+            help='compare the --analyze results with a previously stored report')
+    p.add_argument('--bench', action='store_true',
+            help=('compare the size, (de)compression time and memory usage of'
+                ' different compression methods/levels for the tree and'
+                ' recommend one (cf. --bandwidth, --mem-budget)'))
+    p.add_argument('--bench-configs', metavar='CONFIGS',
+            help=('comma separated list of codec:level[:block size] for --bench,'
+                f' default: {",".join(bench_configs)}'))
+    p.add_argument('--bandwidth', default='10M',
+            help=('bytes per second available for transferring the image to a'
+                ' target, for the --bench recommendation (default: %(default)s)'))
+    p.add_argument('--profile', metavar='JSON',
+            help=('write wall/CPU time, I/O and peak RSS of each build phase'
+                ' to a file'))
+    p.add_argument('--trace', metavar='JSON',
+            help='write the build phases to a file in Chrome trace format')
+    p.add_argument('--matrix', metavar='FILE',
+            help=('build multiple images concurrently, each line of FILE'
+                ' contains the options of one build, e.g. --release 33 --zstd'))
+    p.add_argument('--jobs', '-j', type=int, default=0,
+            help=('concurrent --matrix builds or --fleet hosts'
+                ' (default: number of builds or cores)'))
+    p.add_argument('--max-installs', type=int, default=1,
+            help='concurrent package installs in --matrix builds (default: %(default)s)')
+    p.add_argument('--max-compress', type=int, default=2,
+            help='concurrent image compressions in --matrix builds (default: %(default)s)')
+    p.add_argument('--base-cache', metavar='DIR',
+            help=('keep the installed packages in a base tree (per family,'
+                ' release and package list) and clone it into a fresh --destdir'
+                ' (replacing it) instead of installing the packages each time'))
+    p.add_argument('--pkg-cache', metavar='DIR',
+            help=('dnf cache directory that is kept and shared between builds'
+                ' (default: inside the destdir, --matrix: $PWD/dnf-cache)'))
+    p.add_argument('--mem-budget', metavar='SIZE',
+            help=('fail if the memory required for unpacking the image at boot'
+                ' (compressed image, unpacked files, per-file overhead)'
+                ' exceeds this size, e.g. 400M'))
+    p.add_argument('--hw-profile', metavar='PROFILES',
+            help=('comma separated list of hardware profiles, i.e. just include'
+                ' the kernel modules (and their dependencies) required by them,'
+                f' available: {",".join(sorted(hw_profiles))}'
+                ' (default: include all modules)'))
+    p.add_argument('--modules', metavar='MODULES',
+            help='comma separated list of additional modules for --hw-profile')
+    p.add_argument('--no-prune-firmware', dest='prune_firmware',
+            action='store_false', default=True,
+            help=('also include the firmware files that aren\'t referenced by'
+                ' any included kernel module'))
+    p.add_argument('--keep-firmware', metavar='GLOB', action='append', default=[],
+            help=('keep firmware files matching a pattern (relative to'
+                ' /usr/lib/firmware), even if unreferenced'
+                ' (can be specified multiple times)'))
+    p.add_argument('--closure', action='store_true',
+            help=('just include a list of executables and their shared library'
+                ' closure (and some required config/data files) instead of the'
+                ' complete packages (cf. --closure-list)'))
+    p.add_argument('--closure-list', metavar='FILE',
+            help=('read the --closure list (executables, paths relative to the'
+                ' root) from a file instead of using the default list'))
     p.add_argument('--print-pkgs', action='store_true',
             help='Print default package list')
     p.add_argument('--packages',
@@ -51,8 +291,11 @@ def mk_arg_parser():
             help='create secondary cpio archive with new host key, ssh pubkeys')
     p.add_argument('--keys', default='/root/.ssh/authorized_keys',
             help='authorized keys to copy when using --make-config')
-    p.add_argument('--level', '-l', default='6',
-            help='xz compression level (default: %(default)s)')
+    p.add_argument('--fleet', metavar='INVENTORY',
+            help=('with --make-config: create one config archive per host of'
+                ' the inventory file, in parallel (cf. --jobs)'))
+    p.add_argument('--level', '-l',
+            help='compression level (default: 6 for xz/gz, 19 for zstd, 9 for lz4)')
     p.add_argument('--no-selinux', dest='selinux', default=True, action='store_true',
             help='persitantly disable selinux')
     return p
@@ -66,6 +309,13 @@ def parse_args(*a):
         else:
             args.destdir = f'./initramfs-{args.family}{args.release}'
     args.destdir = os.path.abspath(args.destdir)
+    if args.base_cache:
+        args.base_cache = os.path.abspath(args.base_cache)
+    if args.features and (args.cache or args.layout != 'cpio'):
+        raise RuntimeError('--features is incompatible with --cache and --layout')
+    if args.seekable and (args.features or args.cache or args.layout != 'cpio'):
+        raise RuntimeError('--seekable is incompatible with --features, --cache'
+                ' and --layout')
     if args.destdir == '/':
         raise RuntimeError('You are using --destdir wrong!')
     if not args.initramfs:
@@ -73,23 +323,37 @@ def parse_args(*a):
         if args.make_config:
             args.initramfs = 'config-' + args.initramfs
     args.initramfs = os.path.abspath(args.initramfs)
-    global minimal_pkgs
+    if not args.level and args.compress:
+        args.level = default_levels[args.compress]
+    args.ex_paths = ex_paths + args.exclude
+    args.epoch = None
+    if args.reproducible:
+        args.epoch = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+    args.pkgs = minimal_pkgs
     if args.packages:
         with open(args.packages) as f:
-            minimal_pkgs = [ l[:-1].strip() for l in f if not l.startswith('#') ]
+            args.pkgs = [ l[:-1].strip() for l in f if not l.startswith('#') ]
+    args.closure_files = closure_files
+    if args.closure_list:
+        with open(args.closure_list) as f:
+            args.closure_files = [ l[:-1].strip() for l in f
+                    if not l.startswith('#') and l.strip() ]
     if args.password:
         with open(args.password) as f:
             args.password = f.read().strip()
     if not args.vmlinuz:
         args.vmlinuz = f'{args.family}{args.release}.vmlinuz'
     args.vmlinuz = os.path.abspath(args.vmlinuz)
-    if args.make_config:
-        with open(args.keys) as f:
-            s = f.read()
-            if 'PRIVATE KEY' in s:
-                raise RuntimeError('You have to specify public keys with --keys')
+    if args.make_config and not args.fleet:
+        check_public_keys(args.keys)
     return args
 
+def check_public_keys(filename):
+    with open(filename) as f:
+        s = f.read()
+        if 'PRIVATE KEY' in s:
+            raise RuntimeError('You have to specify public keys with --keys')
+
 minimal_pkgs = [
     'bind-utils',
     'btrfs-progs',
@@ -117,32 +381,208 @@ minimal_pkgs = [
     'xterm-resize',
 ]
 
-def install_pkgs(destdir, release):
-    subprocess.run(['dnf', '-y',
-        '--disablerepo=fedora-modular,updates-modular',
-        f'--installroot={destdir}',
-        f'--releasever={release}',
-        '--setopt=install_weak_deps=false',
-        '--setopt=tsflags=nodocs',
-        'install'] + minimal_pkgs, check=True)
+# set in matrix build workers, i.e. bound the number of concurrent
+# dnf and compressor runs
+install_slots  = None
+compress_slots = None
+
+@profiled
+def install_pkgs(destdir, release, pkgs=minimal_pkgs, cachedir=None):
+    cs = []
+    if cachedir:
+        cs = [ f'--setopt=cachedir={cachedir}', '--setopt=keepcache=True' ]
+    with install_slots or contextlib.nullcontext():
+        subprocess.run(['dnf', '-y',
+            '--disablerepo=fedora-modular,updates-modular',
+            f'--installroot={destdir}',
+            f'--releasever={release}',
+            '--setopt=install_weak_deps=false',
+            '--setopt=tsflags=nodocs'] + cs + [
+            'install'] + pkgs, check=True)
+
+def base_tree_key(family, release, pkgs):
+    h = hashlib.sha256(json.dumps([ family, release, sorted(pkgs) ]).encode())
+    return f'{family}{release}-{h.hexdigest()[:16]}'
+
+# returns: the exit status, i.e. also when the command isn't available
+def try_call(c):
+    try:
+        return subprocess.call(c, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        return 127
+
+def is_subvolume(path):
+    # i.e. the root directory of a btrfs subvolume always has inode 256
+    return (os.lstat(path).st_ino == 256
+            and not try_call(['btrfs', 'subvolume', 'show', path]))
+
+def remove_tree(path):
+    if is_subvolume(path):
+        subprocess.check_call(['btrfs', '-q', 'subvolume', 'delete', path])
+    else:
+        shutil.rmtree(path)
+
+# Installs the packages into a cached base tree, unless there already
+# is one for the same family, release and package list.
+# returns: the base tree
+@profiled
+def mk_base_tree(cache_dir, family, release, pkgs, pkg_cache=None, l=6):
+    base = f'{cache_dir}/{base_tree_key(family, release, pkgs)}'
+    os.makedirs(cache_dir, exist_ok=True)
+    # i.e. concurrent builds (e.g. --matrix lines with different destdirs)
+    # wait for the one that creates the base tree instead of removing
+    # its temporary tree
+    with open(base + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(base):
+            return base
+        tmp = base + '.tmp'
+        if os.path.lexists(tmp):
+            remove_tree(tmp)
+        # i.e. such that it can be cloned with a snapshot
+        if try_call(['btrfs', '-q', 'subvolume', 'create', tmp]):
+            os.mkdir(tmp)
+        install_pkgs(tmp, release, pkgs, pkg_cache)
+        compress_licenses(tmp, l)
+        os.rename(tmp, base)
+    return base
+
+# Clones a tree with a btrfs snapshot, reflinks or hardlinks (whatever
+# works first), i.e. in the latter case files must not be modified in
+# place (cf. remove()).
+@profiled
+def clone_tree(src, dst):
+    if os.path.lexists(dst):
+        remove_tree(dst)
+    for c in [ [ 'btrfs', '-q', 'subvolume', 'snapshot', src, dst ],
+               [ 'cp', '-a', '--reflink=always', src, dst ],
+               [ 'cp', '-al', src, dst ] ]:
+        if not try_call(c):
+            return
+        if os.path.lexists(dst):
+            remove_tree(dst)
+    raise RuntimeError(f'Failed to clone {src} to {dst}')
+
+def test_clone_tree():
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(d + '/base/etc')
+        with open(d + '/base/etc/shadow', 'w') as f:
+            print('root:*:18000:0:99999:7:::', file=f)
+        os.chmod(d + '/base/etc/shadow', 0)
+        os.makedirs(d + '/work/stale')
+        clone_tree(d + '/base', d + '/work')
+        assert os.listdir(d + '/work') == [ 'etc' ]
+        set_password(d + '/work', None, None)
+        with open(d + '/base/etc/shadow') as f:
+            assert f.read() == 'root:*:18000:0:99999:7:::\n'
+        assert stat.S_IMODE(os.stat(d + '/work/etc/shadow').st_mode) == 0
+    assert base_tree_key('f', '34', [ 'b', 'a' ]) == base_tree_key('f', '34', [ 'a', 'b' ])
 
 
+def tar_info(arcname, filename, st):
+    ti = tarfile.TarInfo(arcname)
+    ti.mode  = stat.S_IMODE(st.st_mode)
+    ti.uid   = st.st_uid
+    ti.gid   = st.st_gid
+    ti.mtime = int(st.st_mtime)
+    if stat.S_ISDIR(st.st_mode):
+        ti.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        ti.type = tarfile.SYMTYPE
+        ti.linkname = os.readlink(filename)
+    else:
+        ti.size = st.st_size
+    return ti
+
+def write_tar_member(out, ti, f=None):
+    out.write(ti.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape'))
+    if f and ti.size:
+        tarfile.copyfileobj(f, out, ti.size)
+        out.write(b'\0' * (-ti.size & 511))
+
+def write_tar_stream(f, l, entries, old=None):
+    links = dedup_index(entries)
+    first = {}
+    with lzma.LZMAFile(f, 'wb', preset=int(l)) as out:
+        if old:
+            with tarfile.open(old) as t:
+                for ti in t:
+                    write_tar_member(out, ti, t.extractfile(ti))
+        for arcname, filename, st in entries:
+            ti = tar_info(arcname, filename, st)
+            if arcname in links:
+                k = links[arcname][0]
+                if k in first:
+                    ti.type = tarfile.LNKTYPE
+                    ti.linkname = first[k]
+                    ti.size = 0
+                    write_tar_member(out, ti)
+                    continue
+                first[k] = arcname
+            if ti.isreg():
+                with open(filename, 'rb') as g:
+                    write_tar_member(out, ti, g)
+            else:
+                write_tar_member(out, ti)
+
+# The archive consists of one xz stream per update plus a final stream
+# that just contains the tar end-of-archive marker. Thus, new members
+# are appended by truncating that final stream. The concatenation
+# is still a plain tar.xz archive.
+@profiled
 def compress_licenses(destdir, l=6):
-    subprocess.check_output(['hardlink', '-c', 'usr/share/licenses', 'usr/share/doc'],
-            text=True, cwd=destdir)
-    subprocess.check_output('[ -f licenses.tar.xz ] && tar xf licenses.tar.xz'
-            f' || true && tar -c licenses doc | xz -{l} > licenses.tar.xz'
-            ' && rm -rf licenses doc',
-            shell=True, text=True, cwd=destdir + '/usr/share')
+    base = destdir + '/usr/share'
+    fn  = base + '/licenses.tar.xz'
+    mfn = base + '/licenses.manifest.json'
+    entries = []
+    for d in ('licenses', 'doc'):
+        if os.path.isdir(f'{base}/{d}'):
+            entries.extend((d if rel == '.' else f'{d}/{rel}', filename, st)
+                    for rel, filename, st in walk_tree(f'{base}/{d}'))
+    sig = lambda st: [ st.st_mode, st.st_size, st.st_mtime_ns ]
+    try:
+        with open(mfn) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = None
+    if manifest and os.path.exists(fn):
+        new = [ e for e in entries if manifest['files'].get(e[0]) != sig(e[2]) ]
+        if new:
+            with open(fn, 'r+b') as f:
+                f.truncate(manifest['end'])
+                f.seek(manifest['end'])
+                write_tar_stream(f, l, new)
+                manifest['end'] = f.tell()
+                f.write(lzma.compress(b'\0' * 1024, preset=int(l)))
+    elif entries:
+        manifest = { 'files': {} }
+        with open(fn + '.tmp', 'wb') as f:
+            # i.e. convert an archive created by a previous version
+            write_tar_stream(f, l, entries, fn if os.path.exists(fn) else None)
+            manifest['end'] = f.tell()
+            f.write(lzma.compress(b'\0' * 1024, preset=int(l)))
+        os.rename(fn + '.tmp', fn)
+    if not entries:
+        return
+    manifest['files'].update((arcname, sig(st)) for arcname, _, st in entries)
+    with open(mfn, 'w') as f:
+        json.dump(manifest, f)
+    for d in ('licenses', 'doc'):
+        shutil.rmtree(f'{base}/{d}', ignore_errors=True)
 
+# NB: files are removed before they are (re-)written since the tree
+# might be a hardlink copy of a cached base tree (cf. --base-cache)
 def remove(filename):
     try:
         os.unlink(filename)
     except FileNotFoundError:
         pass
 
+@profiled
 def add_default_nw_config(destdir, network):
     filename = destdir + '/etc/systemd/network/20-wired.network'
+    remove(filename)
     if network:
         with open(filename, 'w') as f:
             print('''[Match]
@@ -150,22 +590,24 @@ Name=e*
 
 [Network]
 DHCP=ipv4''', file=f)
-    else:
-        remove(filename)
 
+@profiled
 def disable_ssh_pw_auth(destdir):
     subprocess.check_call(['sed', '-i',
         's/^PasswordAuthentication yes/PasswordAuthentication no/',
         destdir + '/etc/ssh/sshd_config'])
     # e.g. on Fedora 32
     if os.path.exists(destdir + '/etc/ssh/sshd_config.d'):
+        remove(destdir + '/etc/ssh/sshd_config.d/99-local.conf')
         with open(destdir + '/etc/ssh/sshd_config.d/99-local.conf', 'w') as f:
             print('PasswordAuthentication no', file=f)
 
 
 # by default, the selinux-policy package isn't installed
 # thus, selinux is disabled in the below is a no-op
+@profiled
 def config_selinux(destdir, enable):
+    remove(destdir + '/.autorelabel')
     with open(destdir + '/.autorelabel', 'w') as f:
         pass
     fn = destdir + '/etc/selinux/config'
@@ -186,6 +628,7 @@ def create_links(links):
     for target, link_name in links:
         create_link(target, link_name)
 
+@profiled
 def enable_networkd(destdir):
     try:
         os.mkdir(destdir + '/etc/systemd/system/network-online.target.wants')
@@ -205,6 +648,7 @@ def enable_networkd(destdir):
     create_links((target, f'{destdir}/{link_name}')
             for target, link_name in links)
 
+@profiled
 def enable_resolved(destdir):
     # target link_name
     links = [
@@ -218,6 +662,7 @@ def enable_resolved(destdir):
     create_links((target, f'{destdir}/{link_name}')
             for target, link_name in links)
 
+@profiled
 def disable_repos(destdir):
     repos = [ 'fedora-cisco-openh264.repo', 'fedora-modular.repo',
               'fedora-updates-modular.repo' ]
@@ -225,9 +670,11 @@ def disable_repos(destdir):
     repos = [ x for x in repos if os.path.exists(x) ]
     subprocess.check_call(['sed', '-i', 's/^enabled=1/enabled=0/'] + repos)
 
+@profiled
 def enable_init(destdir):
     create_link('/usr/lib/systemd/systemd', destdir + '/init')
 
+@profiled
 def set_password(destdir, password, salt):
     if password:
         ss = []
@@ -243,9 +690,13 @@ def set_password(destdir, password, salt):
 
     shadow = destdir + '/etc/shadow'
     bak    = destdir + '/etc/shadow-'
+    remove(bak)
     shutil.copy2(shadow, bak)
+    remove(shadow)
+    mode = stat.S_IMODE(os.stat(bak).st_mode)
     # we write this as root, thus 0000 permissions aren't an issue here
-    with open(bak) as f, open(shadow, 'w') as g:
+    with open(bak) as f, open(shadow, 'w',
+            opener=lambda p, flags: os.open(p, flags, mode)) as g:
         for line in f:
             if line.startswith('root:'):
                 xs = line.split(':')
@@ -253,18 +704,16 @@ def set_password(destdir, password, salt):
             else:
                 g.write(line)
 
-# regular expressions are grep-style, i.e. + etc. need to be escaped
+# paths are relative to the root of the tree, each component may contain
+# shell-style wildcards, a trailing slash just excludes the contents of
+# a directory
 ex_paths = [
-        'boot/initramfs',
+        'boot/initramfs*',
         'etc/udev/hwdb.bin',
         'usr/bin/tzselect',
         'usr/lib/.build-id/',
-        'usr/lib/firmware/amdgpu',
-        'usr/lib/firmware/mellanox', # switch firmwares
-        'usr/lib/firmware/mrvl/prestera', # switch firmwares
-        'usr/lib/firmware/qcom', # Qualcom media
-        'usr/lib/modules/[^/]\+/vmlinuz',
-        'usr/lib64/gconv/IBM', # legacy IBM charsets
+        'usr/lib/modules/*/vmlinuz',
+        'usr/lib64/gconv/IBM*', # legacy IBM charsets
         'usr/lib64/gconv/libCNS.so', # charset I don't know
         'usr/lib64/gconv/BIG5HKSCS.so', # charset I don't know
         'usr/share/cracklib/', # serious users don't use dictionary passwords, anyways
@@ -273,81 +722,2366 @@ ex_paths = [
         'usr/share/zoneinfo/',
         'var/cache/',
         'var/lib/dnf/',
-        'var/log/dnf',
+        'var/log/dnf*',
         'var/log/journal',
         ]
 
-def mk_cpio(destdir, compress, initramfs, ex_paths = None, l = 6):
+# Exclusion patterns compiled into a trie of path components such that
+# they can be evaluated while walking the tree, i.e. excluded
+# directories aren't even opened.
+class Exclude_Trie:
+    def __init__(self, patterns=()):
+        self.children = {}
+        self.globs    = []
+        self.exclude  = False
+        self.contents = False
+        for x in patterns:
+            self.insert(x)
+
+    def insert(self, pattern):
+        n = self
+        for x in pattern.strip('/').split('/'):
+            if any(c in x for c in '*?['):
+                for m, c in n.globs:
+                    if m.pattern == fnmatch.translate(x):
+                        break
+                else:
+                    c = Exclude_Trie()
+                    n.globs.append((re.compile(fnmatch.translate(x)), c))
+            else:
+                c = n.children.setdefault(x, Exclude_Trie())
+            n = c
+        if pattern.endswith('/'):
+            n.contents = True
+        else:
+            n.exclude = True
+
+# returns: (exclude, contents only, trie nodes for the children)
+def trie_step(nodes, name):
+    xs = []
+    for n in nodes:
+        c = n.children.get(name)
+        if c:
+            xs.append(c)
+        for m, c in n.globs:
+            if m.match(name):
+                xs.append(c)
+    return (any(x.exclude for x in xs), any(x.contents for x in xs),
+            [ x for x in xs if x.children or x.globs ])
+
+def test_exclude_trie():
+    t = Exclude_Trie([ 'usr/share/locale/', 'usr/lib/modules/*/vmlinuz',
+        'boot/initramfs*' ])
+    assert trie_step([t], 'etc') == (False, False, [])
+    e, c, ns = trie_step([t], 'usr')
+    assert not e and not c and ns
+    assert trie_step(trie_step(ns, 'share')[2], 'locale')[:2] == (False, True)
+    e, c, ns = trie_step(trie_step(ns, 'lib')[2], 'modules')
+    assert trie_step(trie_step(ns, '5.11.12')[2], 'vmlinuz')[0]
+    assert trie_step(trie_step([t], 'boot')[2], 'initramfs-5.11.img')[0]
+    assert not trie_step(trie_step([t], 'boot')[2], 'vmlinuz')[0]
+
+
+# Writes the 'new' (a.k.a. newc) cpio format as understood by the kernel,
+# cf. Documentation/driver-api/early-userspace/buffer-format.rst
+#
+# Headers and small files are collected in one reused buffer, larger
+# files are spliced into the output with sendfile(2).
+# Hardlinked files are stored like GNU cpio does it, i.e. the data
+# is attached to the last link of a group.
+class Cpio_Writer:
+    # owner: (uid, gid) to archive all entries with, e.g. (0, 0)
+    # epoch: reproducible output, i.e. inode numbers are assigned
+    #        sequentially, device numbers are zeroed and mtimes are
+    #        clamped to the epoch
+    # index: list that receives [ name, header offset, mode, data offset,
+    #        size, rdev ] of each entry, where hardlinks refer to the data
+    #        of the name that carries it
+    # usage: list that receives ( name, bytes ) of each entry, i.e. the
+    #        memory it occupies when unpacked (cf. entry_memory())
+    def __init__(self, f, bufsize=1024*1024, owner=None, epoch=None, index=None,
+            usage=None):
+        self.f   = f
+        try:
+            self.fd = f.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # e.g. an in-memory BytesIO
+            self.fd = None
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.n   = 0
+        self.pos = 0
+        self.sendfile = self.fd is not None
+        self.owner = owner
+        self.epoch = epoch
+        self.inos  = {}
+        self.links = {}
+        self.index = index
+        self.usage = usage
+
+    def write(self, v):
+        if self.fd is None:
+            self.f.write(v)
+            return
+        while v:
+            v = v[os.write(self.fd, v):]
+
+    def flush(self):
+        self.write(self.view[:self.n])
+        self.n = 0
+
+    def put(self, b):
+        k = len(b)
+        if self.n + k > len(self.buf):
+            self.flush()
+            if k > len(self.buf):
+                self.pos += k
+                self.write(memoryview(b))
+                return
+        self.view[self.n:self.n+k] = b
+        self.n   += k
+        self.pos += k
+
+    def pad(self):
+        k = -self.pos & 3
+        if k:
+            self.put(b'\0' * k)
+
+    def header(self, name, st, size, nlink=None, rdev=0):
+        start = self.pos
+        if self.index is not None:
+            self.index.append([ name, start, st.st_mode, 0, size, rdev ])
+        if self.usage is not None:
+            self.usage.append((name, entry_memory(st, size)))
+        name = os.fsencode(name) + b'\0'
+        uid, gid = self.owner or (st.st_uid, st.st_gid)
+        ino, dev, mtime = st.st_ino, st.st_dev, max(int(st.st_mtime), 0)
+        if self.epoch is not None:
+            ino = self.inos.setdefault((st.st_dev, st.st_ino), len(self.inos) + 1)
+            dev = 0
+            mtime = min(mtime, self.epoch)
+        self.put(b'070701%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X' % (
+            ino & 0xffffffff, st.st_mode, uid, gid,
+            st.st_nlink if nlink is None else nlink,
+            mtime & 0xffffffff, size,
+            os.major(dev), os.minor(dev),
+            os.major(rdev), os.minor(rdev), len(name), 0))
+        self.put(name)
+        self.pad()
+        if self.index is not None:
+            self.index[-1][3] = self.pos
+
+    def copy(self, filename, size):
+        with open(filename, 'rb', buffering=0) as f:
+            off = 0
+            if size <= len(self.buf) - self.n or not self.sendfile:
+                while off < size:
+                    if self.n == len(self.buf):
+                        self.flush()
+                    k = f.readinto(self.view[self.n:self.n + min(size - off,
+                        len(self.buf) - self.n)])
+                    if not k:
+                        break
+                    self.n   += k
+                    self.pos += k
+                    off      += k
+            else:
+                self.flush()
+                try:
+                    while off < size:
+                        k = os.sendfile(self.fd, f.fileno(), off, size - off)
+                        if not k:
+                            break
+                        off += k
+                except OSError:
+                    if off:
+                        raise
+                    self.sendfile = False
+                    self.pos += off
+                    return self.copy(filename, size)
+                self.pos += off
+            if off != size:
+                raise RuntimeError(f'{filename} changed size while archiving')
+        self.pad()
+
+    # link: (key, count) of an inode/content group (cf. link_index()),
+    # otherwise a regular file is archived with a link count of 1
+    def add(self, name, filename, st, link=None):
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+            if link:
+                return self.add_link(name, filename, st, *link)
+            self.header(name, st, st.st_size, nlink=1)
+            self.copy(filename, st.st_size)
+        elif stat.S_ISLNK(mode):
+            target = os.fsencode(os.readlink(filename))
+            self.header(name, st, len(target))
+            self.put(target)
+            self.pad()
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            self.header(name, st, 0, rdev=st.st_rdev)
+        else:
+            self.header(name, st, 0)
+
+    def add_link(self, name, filename, st, k, n):
+        xs = self.links.setdefault(k, [])
+        xs.append((name, filename, st))
+        if len(xs) == n:
+            self.flush_link(k)
+
+    # i.e. all names share the inode number etc. of the one
+    # that carries the data
+    def flush_link(self, k):
+        xs = self.links.pop(k)
+        name, filename, st = xs[-1]
+        for x, _, _ in xs[:-1]:
+            self.header(x, st, 0, nlink=len(xs))
+        self.header(name, st, st.st_size, nlink=len(xs))
+        self.copy(filename, st.st_size)
+        if self.index is not None:
+            for x in self.index[-len(xs):-1]:
+                x[3:5] = self.index[-1][3:5]
+
+    def close(self):
+        # i.e. groups whose names weren't all added
+        for k in list(self.links):
+            self.flush_link(k)
+        self.put(b'070701' + b'0' * 32 + b'00000001' + b'0' * 48 + b'0000000B'
+                + b'0' * 8 + b'TRAILER!!!\0')
+        self.pad()
+        self.flush()
+
+
+# Entries that are left out of the archive or archived from another file
+# (cf. select_tree()), i.e. without modifying the tree itself
+# exclude: relpaths
+# include: relpaths (including their parent directories), None: all
+# overlay: relpath -> filename that is archived instead
+class Tree_Selection:
+    def __init__(self, exclude=(), include=None, overlay=None):
+        self.exclude = set(exclude)
+        self.include = include
+        self.overlay = overlay or {}
+
+    def __bool__(self):
+        return bool(self.exclude or self.include is not None or self.overlay)
+
+    def wanted(self, relpath):
+        return relpath not in self.exclude and (self.include is None
+                or relpath in self.include)
+
+    # i.e. part of the --cache config
+    def digest(self):
+        h = hashlib.sha256()
+        for x in sorted(self.exclude):
+            h.update(b'-' + os.fsencode(x) + b'\0')
+        if self.include is not None:
+            for x in sorted(self.include):
+                h.update(b'+' + os.fsencode(x) + b'\0')
+        buf = bytearray(1024 * 1024)
+        for x, filename in sorted(self.overlay.items()):
+            h.update(b'=' + os.fsencode(x) + b'\0' + file_digest(filename, buf))
+        return h.hexdigest()
+
+# Single pass over the tree with scandir(), i.e. excluded entries aren't
+# stat'ed at all and the others are lstat'ed exactly once (the archive
+# needs their metadata anyway).
+# Yields (relpath, filename, lstat result) where directories precede
+# their contents and the entries of a directory are sorted by name,
+# i.e. the order doesn't depend on the filesystem.
+def walk_tree(destdir, ex_paths=None, selection=None):
+    sel = selection or None
+    yield '.', destdir, os.lstat(destdir)
+    stack = [ ('', destdir, [ Exclude_Trie(ex_paths) ] if ex_paths else []) ]
+    while stack:
+        rel, path, ns = stack.pop()
+        subdirs = []
+        with os.scandir(path) as it:
+            es = sorted(it, key=lambda e: e.name)
+            for e in es:
+                relpath = f'{rel}/{e.name}' if rel else e.name
+                if ns:
+                    exclude, contents, cs = trie_step(ns, e.name)
+                    if exclude:
+                        continue
+                else:
+                    contents, cs = False, []
+                filename = e.path
+                if sel:
+                    if not sel.wanted(relpath):
+                        continue
+                    filename = sel.overlay.get(relpath, filename)
+                if filename is e.path:
+                    st = e.stat(follow_symlinks=False)
+                else:
+                    st = os.lstat(filename)
+                if stat.S_ISDIR(st.st_mode) and not contents:
+                    subdirs.append((relpath, e.path, cs))
+                yield relpath, filename, st
+        stack.extend(reversed(subdirs))
+
+# i.e. similar content is adjacent in the archive, cf. --order type
+class_order = [ 'symlink', 'special', 'text', 'python', 'data', 'elf-so',
+        'elf-exec', 'kmod', 'firmware' ]
+
+# Orders the entries such that files of the same type and extension
+# follow each other, which improves the window reuse of xz/zstd.
+# All directories (in tree order) precede the other entries, i.e. the
+# kernel still finds the parent directory of each entry.
+def order_entries(entries, order='tree'):
+    if order == 'tree':
+        return entries
+    dirs = []
+    xs = []
+    for relpath, filename, st in entries:
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append((relpath, filename, st))
+            continue
+        head = b''
+        if stat.S_ISREG(st.st_mode) and st.st_size:
+            with open(filename, 'rb') as f:
+                head = f.read(512)
+        # i.e. files of the same package are still close to each other
+        _, dot, ext = relpath.rsplit('/', 1)[-1].rpartition('.')
+        k = (class_order.index(file_class(relpath, st, head)),
+                ext if dot else '', relpath)
+        xs.append((k, (relpath, filename, st)))
+    xs.sort(key=lambda x: x[0])
+    return dirs + [ e for _, e in xs ]
+
+def test_order_entries():
+    with tempfile.TemporaryDirectory() as d:
+        for x in [ 'etc', 'usr/lib64', 'usr/share/doc' ]:
+            os.makedirs(f'{d}/{x}')
+        for x in [ 'etc/a.conf', 'usr/lib64/libx.so.1', 'usr/share/doc/README',
+                'usr/share/doc/b.conf', 'usr/lib64/liby.so.1', 'zz.conf' ]:
+            with open(f'{d}/{x}', 'wb') as f:
+                f.write(mk_test_module(b'') if '.so' in x else b'text\n')
+        os.symlink('lib64', f'{d}/usr/lib')
+        es = list(walk_tree(d))
+        assert order_entries(es) is es
+        xs = [ x[0] for x in order_entries(es, 'type') ]
+        assert xs == [ '.', 'etc', 'usr', 'usr/lib64', 'usr/share', 'usr/share/doc',
+                'usr/lib', 'usr/share/doc/README', 'etc/a.conf', 'usr/share/doc/b.conf',
+                'zz.conf', 'usr/lib64/libx.so.1', 'usr/lib64/liby.so.1' ]
+
+default_levels = { 'xz': '6', 'gz': '6', 'zst': '19', 'lz4': '9' }
+
+# NB: the kernel's xz decoder only supports crc32 (or no) checks and its
+# lz4 decoder only understands the legacy frame format.
+# Multi-threaded xz splits the stream into independently compressed
+# blocks which the kernel's (multi-block capable) decoder reads just fine.
+# reproducible: the output doesn't depend on the number of cores, i.e.
+# xz always runs in multi-threaded mode (its output only depends on
+# the block size, then) - as do zstd and pigz, anyways
+def compress_cmd(compress, l=None, threads=0, block_size=None, reproducible=False):
+    if not compress:
+        return None
+    l = l or default_levels[compress]
+    threads = threads or len(os.sched_getaffinity(0))
     if compress == 'gz':
-        c = ' | gzip'
+        # i.e. don't store a timestamp
+        if shutil.which('pigz'):
+            return [ 'pigz', f'-{l}', '-n', '-p', str(threads) ]
+        return [ 'gzip', f'-{l}', '-n' ]
     elif compress == 'xz':
-        c = f' | xz -{l} --check=crc32'
-    else:
-        c = ''
-    if ex_paths:
-        e = (" | grep -z -v '^\./\("
-            + '\|'.join(ex_paths)
-            + "\)'"
-            )
-    else:
-        e = ''
-    cmd = ('find -print0'
-            + e
-            + ' | cpio --null -o -H newc'
-            + c
-            + ' > ' + initramfs)
-    subprocess.check_call(cmd, shell=True, cwd=destdir)
+        if reproducible:
+            threads = max(threads, 2)
+        c = [ 'xz', f'-{l}', '--check=crc32', f'-T{threads}' ]
+        if block_size:
+            c.append(f'--block-size={block_size}')
+        return c
+    elif compress == 'zst':
+        c = [ 'zstd', '-q', f'-{l}', f'-T{threads}' ]
+        if int(l) > 19:
+            c.append('--ultra')
+        return c
+    elif compress == 'lz4':
+        return [ 'lz4', '-q', '-l', f'-{l}' ]
+    raise RuntimeError(f'Unknown compression: {compress}')
+
+@contextlib.contextmanager
+def open_compressed(filename, c):
+    with open(filename, 'wb') as f:
+        if not c:
+            yield f
+            return
+        p = subprocess.Popen(c, stdin=subprocess.PIPE, stdout=f)
+        try:
+            yield p.stdin
+        finally:
+            p.stdin.close()
+            if p.wait():
+                raise RuntimeError(f'{c[0]} failed: {p.returncode}')
+
+def file_digest(filename, buf):
+    h = hashlib.sha256()
+    v = memoryview(buf)
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            k = f.readinto(buf)
+            if not k:
+                break
+            h.update(v[:k])
+    return h.digest()
 
+# Groups regular files with identical content and metadata such that
+# they can be archived as hardlinks, i.e. the content is stored (and
+# unpacked into RAM) just once.
+# Returns: relpath -> (key, number of group members)
+def dedup_index(entries):
+    by_size = {}
+    for relpath, filename, st in entries:
+        if stat.S_ISREG(st.st_mode) and st.st_size:
+            k = (st.st_size, st.st_mode, st.st_uid, st.st_gid)
+            by_size.setdefault(k, []).append((relpath, filename, st))
+    buf = bytearray(1024 * 1024)
+    groups = {}
+    for k, xs in by_size.items():
+        if len(xs) == 1:
+            continue
+        digests = {}
+        for relpath, filename, st in xs:
+            i = (st.st_dev, st.st_ino)
+            if i not in digests:
+                digests[i] = file_digest(filename, buf)
+            groups.setdefault(k + (digests[i],), []).append(relpath)
+    d = {}
+    for k, xs in groups.items():
+        if len(xs) > 1:
+            for x in xs:
+                d[x] = (k, len(xs))
+    return d
 
+def test_dedup_index():
+    with tempfile.TemporaryDirectory() as d:
+        for x, v in (('a', 'foo'), ('b', 'foo'), ('c', 'bar'), ('d', 'foo')):
+            with open(f'{d}/{x}', 'w') as f:
+                f.write(v)
+        os.chmod(f'{d}/d', 0o600)
+        xs = [ (x, f'{d}/{x}', os.lstat(f'{d}/{x}')) for x in 'abcd' ]
+        i = dedup_index(xs)
+        assert sorted(i) == [ 'a', 'b' ]
+        assert i['a'] == i['b']
+        assert i['a'][1] == 2
+
+# Groups the hardlinks among the entries, i.e. st_nlink isn't trusted
+# since it also counts names outside of them, e.g. of a hardlinked base
+# tree (cf. --base-cache) or of excluded paths.
+# Returns: relpath -> (key, number of group members), as dedup_index()
+def link_index(entries, dedup=False):
+    links = dedup_index(entries) if dedup else {}
+    inodes = {}
+    for relpath, _, st in entries:
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1 and relpath not in links:
+            inodes.setdefault((st.st_dev, st.st_ino), []).append(relpath)
+    for k, xs in inodes.items():
+        if len(xs) > 1:
+            for x in xs:
+                links[x] = (k, len(xs))
+    return links
+
+def write_cpio(out, entries, dedup=False, owner=None, epoch=None, index=None,
+        usage=None):
+    w = Cpio_Writer(out, owner=owner, epoch=epoch, index=index, usage=usage)
+    entries = list(entries)
+    links = link_index(entries, dedup)
+    for relpath, filename, st in entries:
+        w.add(relpath, filename, st, links.get(relpath))
+    w.close()
+
+def test_link_index():
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(d + '/t')
+        for x in 'abc':
+            with open(f'{d}/t/{x}', 'w') as f:
+                f.write(x)
+        os.link(d + '/t/a', d + '/t/a2')
+        # i.e. as a clone of a base tree
+        os.link(d + '/t/b', d + '/b')
+        es = list(walk_tree(d + '/t'))
+        links = link_index(es)
+        assert sorted(links) == [ 'a', 'a2' ] and links['a'][1] == 2
+        index = []
+        write_cpio(io.BytesIO(), es, index=index)
+        # i.e. b isn't held back until the end of the archive
+        assert [ x[0] for x in index ] == [ '.', 'a', 'a2', 'b', 'c' ]
+
+def test_reproducible():
+    with tempfile.TemporaryDirectory() as d:
+        bs = []
+        for x in [ 'a', 'b' ]:
+            os.makedirs(f'{d}/{x}/etc')
+            with open(f'{d}/{x}/etc/hostname', 'w') as f:
+                print('rescue', file=f)
+            os.link(f'{d}/{x}/etc/hostname', f'{d}/{x}/hostname')
+            os.symlink('etc/hostname', f'{d}/{x}/name')
+            os.utime(f'{d}/{x}/etc/hostname', (1, 1))
+            b = io.BytesIO()
+            write_cpio(b, walk_tree(f'{d}/{x}'), epoch=1000)
+            bs.append(b.getvalue())
+        assert bs[0] == bs[1]
+        assert bs[0][6:14] == b'00000001'
+
+def mk_cpio(destdir, compress, initramfs, ex_paths = None, l = None,
+        threads = 0, block_size = None, dedup = False, owner = None, epoch = None,
+        order = 'tree', selection = None, usage = None):
+    c = compress_cmd(compress, l, threads, block_size, epoch is not None)
+    with open_compressed(initramfs, c) as out:
+        write_cpio(out, order_entries(walk_tree(destdir, ex_paths, selection), order),
+                dedup, owner, epoch, usage=usage)
+
+
+# the children of these directories are archived into separate
+# segments, everything else ends up in the segment of its parent
+split_dirs = { '.', 'usr', 'usr/lib', 'usr/share' }
+
+def segment_key(relpath):
+    if relpath == '.':
+        return '.'
+    xs = relpath.split('/')
+    prefix = lambda k: '/'.join(xs[:k]) if k else '.'
+    k = 0
+    while k < len(xs) and prefix(k) in split_dirs:
+        k += 1
+    if k == len(xs):
+        return prefix(k - 1)
+    return prefix(k)
+
+# NB: inode numbers and link counts change when the tree is cloned,
+# thus just the links inside the segment are hashed, i.e. the first
+# name of each group
+def segment_hash(entries):
+    h = hashlib.sha256()
+    first = {}
+    for relpath, filename, st in entries:
+        link = ''
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+            link = first.setdefault((st.st_dev, st.st_ino), relpath)
+        h.update(f'{relpath}\0{st.st_mode} {st.st_uid} {st.st_gid} {st.st_size}'
+                f' {st.st_mtime_ns} {link} {st.st_rdev}\0'
+                .encode(errors='surrogateescape'))
+    return h.hexdigest()
+
+def append_file(f, filename):
+    with open(filename, 'rb') as g:
+        n = os.fstat(g.fileno()).st_size
+        off = 0
+        while off < n:
+            k = os.sendfile(f.fileno(), g.fileno(), off, n - off)
+            if not k:
+                break
+            off += k
+
+# The kernel unpacks concatenated (compressed) cpio archives, thus each
+# segment is compressed on its own and only recompressed when one of its
+# entries changes (cf. the manifest).
+# NB: hardlinks that span segments are stored as separate files.
+def mk_cached_cpio(destdir, compress, initramfs, cache_dir, ex_paths = None,
+        l = None, threads = 0, block_size = None, dedup = False, owner = None,
+        epoch = None, order = 'tree', selection = None, usage = None):
+    c = compress_cmd(compress, l, threads, block_size, epoch is not None)
+    os.makedirs(cache_dir, exist_ok=True)
+    mfn = cache_dir + '/manifest.json'
+    try:
+        with open(mfn) as f:
+            old = json.load(f)
+    except FileNotFoundError:
+        old = {}
+    # i.e. as it is stored in the manifest
+    config = [ c, ex_paths, selection.digest() if selection else None, dedup,
+            list(owner) if owner else None, epoch, order ]
+    if old.get('config') != config:
+        old = {}
+    old_usage = old.get('usage', {})
+    old = old.get('segments', {})
+
+    segs = {}
+    for e in walk_tree(destdir, ex_paths, selection):
+        segs.setdefault(segment_key(e[0]), []).append(e)
+
+    new = {}
+    new_usage = {}
+    fns = []
+    built = 0
+    for key, es in segs.items():
+        h = segment_hash(es)
+        fn = (f'{cache_dir}/{"%" if key == "." else key.replace("/", "%")}'
+                f'.cpio.{compress}')
+        u = old_usage.get(key)
+        if old.get(key) != h or u is None or not os.path.exists(fn):
+            u = []
+            with open_compressed(fn + '.tmp', c) as out:
+                write_cpio(out, order_entries(es, order), dedup, owner, epoch,
+                        usage=u)
+            os.rename(fn + '.tmp', fn)
+            built += 1
+        new[key] = h
+        new_usage[key] = u
+        if usage is not None:
+            usage.extend(u)
+        fns.append(fn)
+    for x in glob.glob(f'{glob.escape(cache_dir)}/*.cpio.*'):
+        if x not in fns:
+            os.unlink(x)
+    with open(mfn + '.tmp', 'w') as f:
+        json.dump({ 'config': config, 'segments': new, 'usage': new_usage }, f)
+    os.rename(mfn + '.tmp', mfn)
+
+    with open(initramfs, 'wb') as f:
+        for fn in fns:
+            append_file(f, fn)
+    print(f'Recompressed {built} of {len(fns)} segments')
+
+
+@profiled
 def cp_kernel(destdir, vmlinuz):
     x = glob.glob(destdir + '/lib/modules/*/vmlinuz')[0]
     shutil.copy(x, vmlinuz)
 
-def make_config(destdir, keys):
+
+# module names or aliases (as in modules.alias) required for some hardware,
+# cf. --hw-profile
+hw_profiles = {
+        'ahci'     : [ 'ahci', 'sd_mod' ],
+        'btrfs'    : [ 'btrfs' ],
+        'dm-crypt' : [ 'dm_crypt', 'crypto-xts', 'crypto-aes', 'crypto-sha256',
+                       'crypto-sha512', 'crypto-essiv', 'algif_skcipher' ],
+        'e1000'    : [ 'e1000', 'e1000e' ],
+        'ext4'     : [ 'ext4' ],
+        'nvme'     : [ 'nvme' ],
+        'overlay'  : [ 'overlay', 'squashfs', 'erofs', 'loop' ],
+        'raid'     : [ 'md_mod', 'raid0', 'raid1', 'raid10', 'raid456' ],
+        'usb'      : [ 'xhci_pci', 'ehci_pci', 'usb_storage', 'uas', 'sd_mod',
+                       'usbhid', 'hid_generic' ],
+        'vfat'     : [ 'vfat', 'nls_cp437', 'nls_iso8859_1' ],
+        'virtio'   : [ 'virtio_pci', 'virtio_blk', 'virtio_scsi', 'virtio_net',
+                       'virtio_console', 'virtio_rng', 'virtio_balloon', 'sd_mod' ],
+        'xfs'      : [ 'xfs' ],
+        }
+
+def module_name(filename):
+    return os.path.basename(filename).split('.ko')[0].replace('-', '_')
+
+def read_modules_dep(moddir):
+    d = {}
+    with open(moddir + '/modules.dep') as f:
+        for line in f:
+            k, _, v = line.partition(':')
+            d[module_name(k)] = (k, [ module_name(x) for x in v.split() ])
+    return d
+
+def read_modules_alias(moddir):
+    xs = []
+    with open(moddir + '/modules.alias') as f:
+        for line in f:
+            if line.startswith('alias '):
+                _, pattern, name = line.split()
+                xs.append((pattern, name.replace('-', '_')))
+    return xs
+
+def read_modules_softdep(moddir):
+    d = {}
+    try:
+        with open(moddir + '/modules.softdep') as f:
+            for line in f:
+                if line.startswith('softdep '):
+                    xs = line.split()
+                    d[xs[1].replace('-', '_')] = [ x.replace('-', '_')
+                            for x in xs[2:] if not x.endswith(':') ]
+    except FileNotFoundError:
+        pass
+    return d
+
+# i.e. the modules that are built into the kernel (cf. modules.builtin)
+# and the aliases and firmware they declare (cf. modules.builtin.modinfo,
+# which contains NUL terminated name.key=value records)
+# returns: ({ name: relpath }, [ (pattern, name) ], [ (name, firmware) ])
+def read_modules_builtin(moddir):
+    names    = {}
+    aliases  = []
+    firmware = []
+    try:
+        with open(moddir + '/modules.builtin') as f:
+            names.update((module_name(x), x) for x in f.read().split())
+    except FileNotFoundError:
+        pass
+    try:
+        with open(moddir + '/modules.builtin.modinfo', 'rb') as f:
+            for x in f.read().split(b'\0'):
+                k, _, v = x.decode(errors='surrogateescape').partition('=')
+                name, _, key = k.partition('.')
+                if key == 'alias':
+                    aliases.append((v, name.replace('-', '_')))
+                elif key == 'firmware':
+                    firmware.append((name.replace('-', '_'), v))
+    except FileNotFoundError:
+        pass
+    return names, aliases, firmware
+
+# Computes the modules required by some module names or aliases, i.e.
+# including their dependencies and soft dependencies, where builtin
+# modules are satisfied by the kernel.
+# Names that can't be resolved are an error, unresolvable soft
+# dependencies are ignored (as modprobe does it).
+# returns: (names, modules.dep as in read_modules_dep())
+def module_closure(moddir, names):
+    deps     = read_modules_dep(moddir)
+    builtin, aliases, _ = read_modules_builtin(moddir)
+    aliases  = read_modules_alias(moddir) + aliases
+    softdeps = read_modules_softdep(moddir)
+    def resolve(x):
+        if x in deps or x in builtin:
+            return [ x ]
+        return [ name for pattern, name in aliases
+                if fnmatch.fnmatchcase(x, pattern.replace('-', '_')) ]
+    todo    = []
+    unknown = []
+    for x in names:
+        ms = resolve(x.replace('-', '_'))
+        if not ms:
+            unknown.append(x)
+        todo.extend(ms)
+    if unknown:
+        raise RuntimeError(f'Unknown modules or aliases for'
+                f' {os.path.basename(moddir)}: {", ".join(unknown)}')
+    keep = set()
+    seen = set()
+    while todo:
+        x = todo.pop()
+        if x in seen:
+            continue
+        seen.add(x)
+        if x in deps:
+            keep.add(x)
+            todo.extend(deps[x][1])
+            todo.extend(y for z in softdeps.get(x, ()) for y in resolve(z))
+        elif x not in builtin:
+            todo.extend(resolve(x))
+    return keep, deps
+
+def test_module_closure():
+    with tempfile.TemporaryDirectory() as d:
+        with open(d + '/modules.dep', 'w') as f:
+            print('kernel/fs/btrfs/btrfs.ko.xz: kernel/lib/raid6/raid6_pq.ko.xz'
+                    ' kernel/lib/libcrc32c.ko.xz', file=f)
+            print('kernel/lib/raid6/raid6_pq.ko.xz:', file=f)
+            print('kernel/lib/libcrc32c.ko.xz:', file=f)
+            print('kernel/crypto/crc32c_generic.ko.xz:', file=f)
+            print('kernel/drivers/gpu/drm/amd/amdgpu/amdgpu.ko.xz:', file=f)
+        with open(d + '/modules.alias', 'w') as f:
+            print('alias fs-btrfs btrfs', file=f)
+            print('alias crypto-crc32c crc32c_generic', file=f)
+        with open(d + '/modules.softdep', 'w') as f:
+            print('softdep libcrc32c pre: crypto-crc32c', file=f)
+            print('softdep btrfs pre: crypto-blake2b', file=f)
+        keep, deps = module_closure(d, [ 'fs-btrfs' ])
+        assert keep == { 'btrfs', 'raid6_pq', 'libcrc32c', 'crc32c_generic' }
+        with open(d + '/modules.builtin', 'w') as f:
+            print('kernel/crypto/sha256_generic.ko', file=f)
+        with open(d + '/modules.builtin.modinfo', 'wb') as f:
+            f.write(b'sha256_generic.license=GPL\0sha256_generic.alias=crypto-sha256\0'
+                    b'sha256_generic.alias=sha256\0')
+        keep, deps = module_closure(d, [ 'btrfs', 'crypto-sha256', 'sha256-generic' ])
+        assert keep == { 'btrfs', 'raid6_pq', 'libcrc32c', 'crc32c_generic' }
+        try:
+            module_closure(d, [ 'btrfs', 'crypto-sha1', 'brtfs' ])
+            assert False
+        except RuntimeError as e:
+            assert str(e).endswith(': crypto-sha1, brtfs')
+
+class Elf_File:
+    def __init__(self, b):
+        if b[:4] != b'\x7fELF':
+            raise ValueError('not an ELF file')
+        self.b = b
+        self.bits = 64 if b[4] == 2 else 32
+        self.end  = '<' if b[5] == 1 else '>'
+        if self.bits == 64:
+            (self.type, self.machine, _, self.entry, self.phoff, self.shoff, _,
+                    _, self.phentsize, self.phnum, self.shentsize, self.shnum,
+                    self.shstrndx) = struct.unpack_from(self.end + 'HHIQQQIHHHHHH', b, 16)
+        else:
+            (self.type, self.machine, _, self.entry, self.phoff, self.shoff, _,
+                    _, self.phentsize, self.phnum, self.shentsize, self.shnum,
+                    self.shstrndx) = struct.unpack_from(self.end + 'HHIIIIIHHHHHH', b, 16)
+
+    # returns: [ (name, type, flags, addr, offset, size, link) ]
+    def sections(self):
+        xs = []
+        for i in range(self.shnum):
+            off = self.shoff + i * self.shentsize
+            fmt = 'IIQQQQI' if self.bits == 64 else 'IIIIIII'
+            xs.append(list(struct.unpack_from(self.end + fmt, self.b, off)))
+        if xs and self.shstrndx < len(xs):
+            strtab = xs[self.shstrndx]
+            for x in xs:
+                x[0] = self.cstr(strtab[4] + x[0])
+        return [ tuple(x) for x in xs ]
+
+    def section(self, name):
+        for x in self.sections():
+            if x[0] == name:
+                return self.b[x[4]:x[4]+x[5]]
+        return None
+
+    # NB: find() instead of index() since b might be a mmap
+    def cstr(self, off):
+        end = self.b.find(b'\0', off)
+        if end < 0:
+            raise ValueError('unterminated string')
+        return self.b[off:end].decode(errors='replace')
+
+    def interp(self):
+        b = self.section('.interp')
+        return b.split(b'\0')[0].decode() if b else None
+
+    # returns: [ (tag, value) ] where string values are already resolved
+    # for DT_NEEDED, DT_RPATH and DT_RUNPATH
+    def dynamic(self):
+        xs = self.sections()
+        for name, t, _, _, offset, size, link in xs:
+            if name == '.dynamic':
+                break
+        else:
+            return []
+        strtab = xs[link][4]
+        fmt = self.end + ('qQ' if self.bits == 64 else 'iI')
+        k = struct.calcsize(fmt)
+        ds = []
+        for off in range(offset, offset + size - k + 1, k):
+            tag, v = struct.unpack_from(fmt, self.b, off)
+            if tag == 0: # DT_NULL
+                break
+            if tag in (1, 15, 29): # DT_NEEDED, DT_RPATH, DT_RUNPATH
+                v = self.cstr(strtab + v)
+            ds.append((tag, v))
+        return ds
+
+def read_module(filename):
+    if filename.endswith('.xz'):
+        with lzma.open(filename) as f:
+            return f.read()
+    elif filename.endswith('.gz'):
+        with gzip.open(filename) as f:
+            return f.read()
+    elif filename.endswith('.zst'):
+        with subprocess.Popen(['zstd', '-qdc', filename],
+                stdout=subprocess.PIPE) as p:
+            b = p.stdout.read()
+        if p.returncode:
+            raise RuntimeError(f'zstd failed on {filename}: {p.returncode}')
+        return b
+    with open(filename, 'rb') as f:
+        return f.read()
+
+# i.e. what `modinfo -F firmware` prints
+def module_firmware(filename):
+    b = Elf_File(read_module(filename)).section('.modinfo') or b''
+    return [ x[9:].decode() for x in b.split(b'\0') if x.startswith(b'firmware=') ]
+
+# firmware referenced by these modules isn't included, i.e. graphics,
+# media and sound firmware is of little use in a headless rescue system
+# (as are switch firmwares)
+fw_ignore_modules = [
+        'kernel/drivers/gpu/*',
+        'kernel/drivers/media/*',
+        'kernel/drivers/net/ethernet/marvell/prestera/*',
+        'kernel/drivers/net/ethernet/mellanox/mlxsw/*',
+        'kernel/sound/*',
+        ]
+
+fw_suffixes = ('.xz', '.zst')
+
+# Selects the firmware files that are referenced by the modules that
+# are archived (i.e. that aren't excluded, cf. select_modules()) or
+# builtin or that match a keep pattern.
+# returns: the relpaths of the other firmware files
+@profiled
+def select_firmware(destdir, keep=(), exclude=()):
+    fwdir = destdir + '/usr/lib/firmware'
+    if not os.path.isdir(fwdir):
+        return set()
+    ignored = lambda relpath: any(fnmatch.fnmatchcase(relpath, x)
+            for x in fw_ignore_modules)
+    mods = []
+    refs = set()
+    for moddir in glob.glob(destdir + '/usr/lib/modules/*/modules.dep'):
+        moddir = os.path.dirname(moddir)
+        rel = os.path.relpath(moddir, destdir)
+        for relpath, _ in read_modules_dep(moddir).values():
+            if f'{rel}/{relpath}' in exclude:
+                continue
+            if not ignored(relpath):
+                mods.append(f'{moddir}/{relpath}')
+        builtin, _, firmware = read_modules_builtin(moddir)
+        refs.update(x for name, x in firmware if not ignored(builtin.get(name, '')))
+    with concurrent.futures.ThreadPoolExecutor() as ex:
+        refs.update(x for xs in ex.map(module_firmware, mods) for x in xs)
+    pats = [ x for x in refs if any(c in x for c in '*?[') ] + list(keep)
+
+    def wanted(relpath):
+        for suffix in fw_suffixes:
+            if relpath.endswith(suffix):
+                relpath = relpath[:-len(suffix)]
+        return relpath in refs or any(fnmatch.fnmatchcase(relpath, x) for x in pats)
+
+    entries = [ e for e in walk_tree(fwdir) if e[0] != '.' ]
+    files = { relpath: (filename, st) for relpath, filename, st in entries }
+    keep_set = set()
+    for relpath, (filename, st) in files.items():
+        if stat.S_ISDIR(st.st_mode) or not wanted(relpath):
+            continue
+        # i.e. also keep the targets of (chained) symlinks
+        while relpath in files and relpath not in keep_set:
+            keep_set.add(relpath)
+            filename, st = files[relpath]
+            if not stat.S_ISLNK(st.st_mode):
+                break
+            relpath = os.path.normpath(os.path.join(os.path.dirname(relpath),
+                os.readlink(filename)))
+    r = set()
+    n = 0
+    for relpath, filename, st in entries:
+        if not stat.S_ISDIR(st.st_mode) and relpath not in keep_set:
+            r.add(f'usr/lib/firmware/{relpath}')
+            n += st.st_size
+    print(f'Selected {len(keep_set)} firmware files referenced by {len(mods)} modules,'
+            f' leaving out {fmt_size(n)}')
+    return r
+
+def mk_test_module(modinfo):
+    shstrtab = b'\0.modinfo\0.shstrtab\0'
+    shoff = 64 + len(modinfo) + len(shstrtab)
+    b = struct.pack('<4sBBBB8xHHIQQQIHHHHHH', b'\x7fELF', 2, 1, 1, 0,
+            1, 62, 1, 0, 0, shoff, 0, 64, 0, 0, 64, 3, 2)
+    b += modinfo + shstrtab + bytes(64)
+    b += struct.pack('<IIQQQQIIQQ', 1, 1, 2, 0, 64, len(modinfo), 0, 0, 1, 0)
+    b += struct.pack('<IIQQQQIIQQ', 10, 3, 0, 0, 64 + len(modinfo),
+            len(shstrtab), 0, 0, 1, 0)
+    return b
+
+def test_select_firmware():
+    with tempfile.TemporaryDirectory() as d:
+        moddir = d + '/usr/lib/modules/5.11.0'
+        fwdir = d + '/usr/lib/firmware'
+        os.makedirs(moddir + '/kernel')
+        os.makedirs(fwdir + '/rtl_nic')
+        os.makedirs(fwdir + '/amdgpu')
+        with open(moddir + '/modules.dep', 'w') as f:
+            print('kernel/r8169.ko.xz:', file=f)
+        with lzma.open(moddir + '/kernel/r8169.ko.xz', 'wb') as f:
+            f.write(mk_test_module(b'license=GPL\0firmware=rtl_nic/rtl8168d-1.fw\0'
+                b'firmware=rtl_nic/rtl8168e-*.fw\0'))
+        assert module_firmware(moddir + '/kernel/r8169.ko.xz') == [
+                'rtl_nic/rtl8168d-1.fw', 'rtl_nic/rtl8168e-*.fw' ]
+        # i.e. builtin drivers reference firmware, too
+        with open(moddir + '/modules.builtin', 'w') as f:
+            print('kernel/drivers/net/tg3.ko', file=f)
+            print('kernel/drivers/gpu/drm/amd/amdgpu/amdgpu.ko', file=f)
+        with open(moddir + '/modules.builtin.modinfo', 'wb') as f:
+            f.write(b'tg3.license=GPL\0tg3.firmware=tigon/tg3.bin\0'
+                    b'amdgpu.firmware=amdgpu/navi10_sos.bin\0')
+        os.makedirs(fwdir + '/tigon')
+        for x in [ 'rtl_nic/rtl8168d-1.fw.xz', 'rtl_nic/rtl8168e-2.fw.xz',
+                'rtl_nic/rtl8168g-1.fw', 'rtl_nic/blob.fw', 'amdgpu/navi10_sos.bin',
+                'tigon/tg3.bin' ]:
+            with open(f'{fwdir}/{x}', 'w') as f:
+                pass
+        os.symlink('blob.fw', fwdir + '/rtl_nic/rtl8168g-2.fw')
+        ex = select_firmware(d, [ 'rtl_nic/rtl8168g-2.fw' ])
+        assert ex == { 'usr/lib/firmware/amdgpu/navi10_sos.bin',
+                'usr/lib/firmware/rtl_nic/rtl8168g-1.fw' }
+        assert os.path.exists(fwdir + '/amdgpu/navi10_sos.bin')
+        xs = [ x[0] for x in walk_tree(d, None, Tree_Selection(ex))
+                if x[0].startswith('usr/lib/firmware/') ]
+        assert xs == [ 'usr/lib/firmware/amdgpu', 'usr/lib/firmware/rtl_nic',
+                'usr/lib/firmware/tigon',
+                'usr/lib/firmware/rtl_nic/blob.fw', 'usr/lib/firmware/rtl_nic/rtl8168d-1.fw.xz',
+                'usr/lib/firmware/rtl_nic/rtl8168e-2.fw.xz',
+                'usr/lib/firmware/rtl_nic/rtl8168g-2.fw',
+                'usr/lib/firmware/tigon/tg3.bin' ]
+        # i.e. the firmware of left out modules isn't selected
+        ex = select_firmware(d, exclude={ 'usr/lib/modules/5.11.0/kernel/r8169.ko.xz' })
+        assert len(ex) == 6
+
+# returns: the module names (or aliases) of some hardware profiles
+def profile_modules(profiles, extra=()):
+    names = list(extra)
+    for p in profiles:
+        if p not in hw_profiles:
+            raise RuntimeError(f'Unknown hardware profile: {p}'
+                    f' (available: {", ".join(sorted(hw_profiles))})')
+        names.extend(hw_profiles[p])
+    return names
+
+# Selects the modules required by some names (cf. module_closure()) and
+# regenerates the module dependency files for just them below stage_dir,
+# i.e. depmod sees the final module set while the tree isn't modified.
+# returns: (excluded relpaths, { relpath: regenerated file })
+@profiled
+def select_modules(destdir, names, stage_dir):
+    exclude = set()
+    overlay = {}
+    for moddir in sorted(glob.glob(destdir + '/usr/lib/modules/*/modules.dep')):
+        moddir = os.path.dirname(moddir)
+        kver = os.path.basename(moddir)
+        rel = os.path.relpath(moddir, destdir)
+        keep, deps = module_closure(moddir, names)
+        sdir = f'{stage_dir}/usr/lib/modules/{kver}'
+        os.makedirs(sdir)
+        n = 0
+        for name, (relpath, _) in deps.items():
+            if name in keep:
+                os.makedirs(os.path.dirname(f'{sdir}/{relpath}'), exist_ok=True)
+                link_or_copy(f'{moddir}/{relpath}', f'{sdir}/{relpath}')
+            else:
+                exclude.add(f'{rel}/{relpath}')
+                n += os.lstat(f'{moddir}/{relpath}').st_size
+        inputs = [ 'modules.order', 'modules.builtin', 'modules.builtin.modinfo' ]
+        for x in inputs:
+            if os.path.exists(f'{moddir}/{x}'):
+                shutil.copy(f'{moddir}/{x}', f'{sdir}/{x}')
+        if not os.path.lexists(stage_dir + '/lib'):
+            os.symlink('usr/lib', stage_dir + '/lib')
+        subprocess.check_call(['depmod', '-a', '-b', stage_dir, kver])
+        for x in sorted(os.listdir(sdir)):
+            if not x.startswith('modules.') or x in inputs:
+                continue
+            try:
+                st = os.stat(f'{moddir}/{x}')
+            except FileNotFoundError:
+                continue
+            # i.e. unchanged dependency files don't invalidate --cache segments
+            os.chmod(f'{sdir}/{x}', stat.S_IMODE(st.st_mode))
+            os.utime(f'{sdir}/{x}', ns=(st.st_atime_ns, st.st_mtime_ns))
+            overlay[f'{rel}/{x}'] = f'{sdir}/{x}'
+        print(f'Selected {len(keep)} of {len(deps)} modules for {kver},'
+                f' leaving out {fmt_size(n)}')
+    return exclude, overlay
+
+# Classes of files that --debloat removes from the tree, i.e. shell-style
+# wildcards that are matched against the complete relative path
+# (a * also matches a slash). The debug class is special, i.e. it
+# strips the symbol and debug sections of executables and libraries.
+debloat_classes = {
+        # i.e. the bytecode for python -O/-OO
+        'bytecode' : [ '*/__pycache__/*.opt-1.pyc', '*/__pycache__/*.opt-2.pyc' ],
+        # i.e. what tsflags=nodocs misses
+        'docs'     : [ 'usr/share/doc/*', 'usr/share/gtk-doc/*', 'usr/share/help/*',
+                       'usr/share/info/*', 'usr/share/man/*' ],
+        'devel'    : [ 'usr/include/*', 'usr/lib*/*.a', 'usr/lib*/*.la',
+                       'usr/lib*/cmake/*', 'usr/lib*/pkgconfig/*',
+                       'usr/share/aclocal/*', 'usr/share/pkgconfig/*' ],
+        'debug'    : [],
+        }
+
+# returns: the size of the sections that `strip --strip-unneeded` removes
+# from an executable or shared library, i.e. 0 if there is nothing to strip
+def strippable(filename):
+    with open(filename, 'rb') as f:
+        if f.read(4) != b'\x7fELF':
+            return 0
+        b = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        e = Elf_File(b)
+        if e.type not in (2, 3): # ET_EXEC, ET_DYN
+            return 0
+        return sum(size for name, t, flags, _, _, size, _ in e.sections()
+                if not flags & 2 and t != 8 # i.e. not SHF_ALLOC/SHT_NOBITS
+                and (name in ('.symtab', '.strtab') or name.startswith('.debug')))
+    except (ValueError, struct.error):
+        return 0
+    finally:
+        b.close()
+
+# Strips copies of the files which then replace the originals, i.e. a
+# hardlinked base tree (cf. --base-cache) isn't modified.
+# Hardlinks inside the tree are preserved.
+# returns: the number of bytes saved
+def strip_files(groups, batch=256):
+    tmps = []
+    for filename, *_ in groups:
+        d, name = os.path.split(filename)
+        tmp = f'{d}/.{name}.strip'
+        shutil.copyfile(filename, tmp)
+        tmps.append(tmp)
+    for i in range(0, len(tmps), batch):
+        if subprocess.call(['strip', '--strip-unneeded'] + tmps[i:i+batch]):
+            print('strip failed on some files, keeping those unstripped')
+    n = 0
+    for tmp, (filename, *links) in zip(tmps, groups):
+        st = os.lstat(filename)
+        # i.e. chown clears setuid bits and file capabilities
+        os.chown(tmp, st.st_uid, st.st_gid)
+        shutil.copystat(filename, tmp, follow_symlinks=False)
+        n += st.st_size - os.path.getsize(tmp)
+        os.rename(tmp, filename)
+        for x in links:
+            os.unlink(x)
+            os.link(filename, x)
+    return n
+
+# Removes (or strips) the selected classes of files from the tree and
+# reports the bytes saved per class.
+@profiled
+def debloat(destdir, classes):
+    for c in classes:
+        if c not in debloat_classes:
+            raise RuntimeError(f'Unknown debloat class: {c}'
+                    f' (available: {", ".join(debloat_classes)})')
+    pats = [ (c, re.compile('|'.join(fnmatch.translate(x)
+        for x in debloat_classes[c]))) for c in classes if debloat_classes[c] ]
+    saved = { c: [0, 0] for c in classes }
+    inodes = {}
+    parents = set()
+    entries = list(walk_tree(destdir))
+    for relpath, filename, st in entries:
+        if stat.S_ISDIR(st.st_mode):
+            continue
+        c = next((c for c, p in pats if p.match(relpath)), None)
+        if c:
+            saved[c][0] += 1
+            saved[c][1] += st.st_size
+            os.unlink(filename)
+            parents.add(os.path.dirname(relpath))
+        elif ('debug' in classes and stat.S_ISREG(st.st_mode)
+                and not relpath.startswith('usr/lib/debug/')):
+            inodes.setdefault((st.st_dev, st.st_ino), []).append(filename)
+    for relpath, filename, st in reversed(entries):
+        if relpath in parents and relpath != '.' and not os.listdir(filename):
+            os.rmdir(filename)
+            parents.add(os.path.dirname(relpath))
+    if 'debug' in classes:
+        groups = [ xs for xs in inodes.values() if strippable(xs[0]) ]
+        saved['debug'] = [ sum(len(xs) for xs in groups), strip_files(groups) ]
+    for c, (n, size) in saved.items():
+        print(f'Debloat {c:10} {n:7} files {fmt_size(size):>12}')
+    print(f'Debloat {"total":10} {sum(x[0] for x in saved.values()):7} files'
+            f' {fmt_size(sum(x[1] for x in saved.values())):>12}')
+
+def test_debloat():
+    with tempfile.TemporaryDirectory() as d:
+        t = d + '/t'
+        for x in [ 'usr/lib64/python3.9/__pycache__', 'usr/share/man/man1',
+                'usr/bin' ]:
+            os.makedirs(f'{t}/{x}')
+        for x in [ 'a.cpython-39.pyc', 'a.cpython-39.opt-1.pyc',
+                'a.cpython-39.opt-2.pyc' ]:
+            with open(f'{t}/usr/lib64/python3.9/__pycache__/{x}', 'w') as f:
+                f.write(x)
+        for x in [ 'usr/share/man/man1/ls.1.gz', 'usr/lib64/libx.a', 'usr/bin/ls' ]:
+            with open(f'{t}/{x}', 'w') as f:
+                f.write(x)
+        # i.e. as a hardlink copy of a base tree
+        os.link(f'{t}/usr/lib64/libx.a', f'{d}/libx.a')
+        debloat(t, [ 'bytecode', 'docs', 'devel' ])
+        # i.e. also the directories that became empty
+        xs = sorted(x[0] for x in walk_tree(t))
+        assert xs == [ '.', 'usr', 'usr/bin', 'usr/bin/ls', 'usr/lib64',
+                'usr/lib64/python3.9', 'usr/lib64/python3.9/__pycache__',
+                'usr/lib64/python3.9/__pycache__/a.cpython-39.pyc' ]
+        assert os.path.exists(f'{d}/libx.a')
+
+# Executables (looked up in /usr/bin and /usr/sbin) and other paths
+# (relative to the root of the tree, i.e. they contain a slash) for
+# --closure. A trailing slash includes a directory with all its
+# contents, shell-style wildcards are supported.
+closure_files = [
+        # boot, init and configuration
+        '/bin', '/sbin', '/lib', '/lib64', '/init',
+        '/dev', '/proc', '/sys', '/run', '/tmp', '/mnt', 'root/',
+        'etc/',
+        'usr/lib/os-release',
+        'usr/lib/systemd/',
+        'usr/lib64/systemd/',
+        'usr/lib/udev/',
+        'usr/lib/modprobe.d/',
+        'usr/lib/sysctl.d/',
+        'usr/lib/sysusers.d/',
+        'usr/lib/tmpfiles.d/',
+        'usr/lib/modules/',
+        'usr/lib/firmware/',
+        'usr/lib/locale/C.utf8/',
+        'usr/lib64/gconv/gconv-modules*',
+        'usr/lib64/libnss_*',
+        'usr/lib64/security/',
+        'usr/libexec/openssh/',
+        'usr/share/dbus-1/',
+        'usr/share/empty.sshd',
+        'usr/share/licenses.*',
+        'usr/share/terminfo/',
+        'var/empty/',
+        'var/lib/systemd/',
+        'var/log/',
+        'var/run',
+        'var/tmp',
+        # tools
+        'agetty', 'blkid', 'btrfs', 'cat', 'chmod', 'chown', 'chroot', 'cp',
+        'cryptsetup', 'date', 'dd', 'df', 'dig', 'dmesg', 'du', 'e2fsck',
+        'fdisk', 'fsck*', 'grep', 'gzip', 'head', 'hostname', 'ip', 'journalctl',
+        'kill', 'kmod', 'less', 'ln', 'login', 'ls', 'lsblk', 'lsmod',
+        'mkdir', 'mkfs*', 'mkswap', 'modprobe', 'mount', 'mv', 'nologin',
+        'passwd', 'ping', 'ps', 'readlink', 'reboot', 'resize', 'resize2fs',
+        'rm', 'scp', 'sed', 'sfdisk', 'sh', 'bash', 'shutdown', 'sort', 'ssh',
+        'ssh-keygen', 'sshd', 'sulogin', 'swapon', 'switch_root', 'sync',
+        'systemctl', 'tail', 'tar', 'tmux', 'touch', 'udevadm', 'umount',
+        'uname', 'vi', 'wc', 'which', 'wipefs', 'xfs_*', 'xz',
+        ]
+
+# Resolves a path inside the tree, i.e. absolute symlinks are relative
+# to the root of the tree. Traversed symlinks are added to links.
+# returns: the relative path or None if it doesn't exist
+def tree_resolve(destdir, path, links):
+    parts = [ x for x in path.split('/') if x and x != '.' ]
+    cur   = []
+    hops  = 0
+    while parts:
+        x = parts.pop(0)
+        if x == '..':
+            if cur:
+                cur.pop()
+            continue
+        rel = '/'.join(cur + [x])
+        try:
+            st = os.lstat(f'{destdir}/{rel}')
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if stat.S_ISLNK(st.st_mode):
+            hops += 1
+            if hops > 40:
+                return None
+            links.add(rel)
+            t = os.readlink(f'{destdir}/{rel}')
+            if t.startswith('/'):
+                cur = []
+            parts = [ y for y in t.split('/') if y and y != '.' ] + parts
+        else:
+            cur.append(x)
+    return '/'.join(cur) or '.'
+
+def ld_so_conf(destdir, filename='/etc/ld.so.conf'):
+    dirs = []
+    try:
+        with open(destdir + filename) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line.startswith('include '):
+                    pat = line[8:].strip()
+                    if not pat.startswith('/'):
+                        pat = os.path.dirname(filename) + '/' + pat
+                    for x in sorted(glob.glob(glob.escape(destdir) + pat)):
+                        dirs.extend(ld_so_conf(destdir, x[len(destdir):]))
+                elif line:
+                    dirs.append(line)
+    except FileNotFoundError:
+        pass
+    return dirs
+
+# Computes the set of files required by some executables, i.e. their
+# ELF shared library closure (DT_NEEDED, PT_INTERP, RPATH/RUNPATH)
+# and script interpreters, plus all parent directories.
+# returns: (relpaths, missing)
+def file_closure(destdir, patterns):
+    keep    = set()
+    todo    = []
+    missing = set()
+    def add(path):
+        links = set()
+        rel = tree_resolve(destdir, path, links)
+        keep.update(links)
+        if rel is not None and rel not in keep:
+            keep.add(rel)
+            todo.append(rel)
+        return rel
+
+    for p in patterns:
+        ps = [ p ] if '/' in p else [ f'usr/bin/{p}', f'usr/sbin/{p}' ]
+        ms = [ x for q in ps for x in glob.glob(f'{glob.escape(destdir)}/{q.rstrip("/")}') ]
+        if not ms and '/' not in p:
+            missing.add(p)
+        for m in ms:
+            rel = add(m[len(destdir):])
+            if p.endswith('/') and rel is not None:
+                for r, _, _ in walk_tree(f'{destdir}/{rel}'):
+                    if r != '.':
+                        add(f'{rel}/{r}')
+
+    lib_dirs = ld_so_conf(destdir) + [ '/lib64', '/usr/lib64', '/lib', '/usr/lib' ]
+    while todo:
+        rel = todo.pop()
+        filename = f'{destdir}/{rel}'
+        if not stat.S_ISREG(os.lstat(filename).st_mode):
+            continue
+        with open(filename, 'rb') as f:
+            head = f.read(256)
+            if head.startswith(b'#!'):
+                interp = head[2:].split(b'\n')[0].split()
+                if interp:
+                    add(os.fsdecode(interp[0]))
+                continue
+            if not head.startswith(b'\x7fELF'):
+                continue
+            f.seek(0)
+            e = Elf_File(f.read())
+        if e.interp():
+            add(e.interp())
+        ds = e.dynamic()
+        origin = '/' + os.path.dirname(rel)
+        runpath = [ v for t, v in ds if t == 29 ]
+        rpath   = [] if runpath else [ v for t, v in ds if t == 15 ]
+        search = [ x.replace('$ORIGIN', origin).replace('${ORIGIN}', origin)
+                for v in rpath + runpath for x in v.split(':') if x ] + lib_dirs
+        for t, name in ds:
+            if t != 1: # DT_NEEDED
+                continue
+            for d in ([ '' ] if '/' in name else search):
+                r = tree_resolve(destdir, f'{d}/{name}', set())
+                if r is None:
+                    continue
+                with open(f'{destdir}/{r}', 'rb') as f:
+                    h = f.read(6)
+                # i.e. skip e.g. 32 bit libraries when resolving for 64 bit
+                if h[:4] == b'\x7fELF' and h[4] == e.b[4] and h[5] == e.b[5]:
+                    add(f'{d}/{name}')
+                    break
+            else:
+                missing.add(name)
+
+    for rel in list(keep):
+        while '/' in rel:
+            rel = os.path.dirname(rel)
+            keep.add(rel)
+    keep.add('.')
+    return keep, missing
+
+# Selects the file closure for archiving, i.e. everything else (e.g. the
+# rpm database) stays in the tree but is left out of the archive.
+# returns: the relpaths to include
+@profiled
+def select_closure(destdir, patterns):
+    keep, missing = file_closure(destdir, patterns)
+    if missing:
+        print(f'Missing from the closure: {", ".join(sorted(missing))}')
+    n = 0
+    k = 0
+    for relpath, filename, st in walk_tree(destdir):
+        if relpath in keep:
+            k += st.st_size
+        elif not stat.S_ISDIR(st.st_mode):
+            n += st.st_size
+    print(f'Selected {len(keep)} files ({fmt_size(k)}) of the closure,'
+            f' leaving out {fmt_size(n)}')
+    return keep
+
+def test_file_closure():
+    with tempfile.TemporaryDirectory() as d:
+        for x in [ 'usr/bin', 'usr/lib64/systemd', 'etc/ssh' ]:
+            os.makedirs(f'{d}/{x}')
+        os.symlink('usr/lib64', d + '/lib64')
+        shutil.copy(sys.executable, d + '/usr/bin/python3')
+        with open(d + '/usr/bin/hello', 'w') as f:
+            print('#!/usr/bin/python3', file=f)
+        exe = Elf_File(open(sys.executable, 'rb').read())
+        for t, name in exe.dynamic():
+            if t == 1:
+                with open(f'{d}/usr/lib64/{name}', 'wb') as f:
+                    f.write(mk_test_module(b''))
+        interp = exe.interp()
+        if interp:
+            os.makedirs(d + os.path.dirname(interp), exist_ok=True)
+            with open(d + interp, 'wb') as f:
+                f.write(mk_test_module(b''))
+        with open(d + '/usr/bin/other', 'w') as f:
+            pass
+        with open(d + '/etc/ssh/sshd_config', 'w') as f:
+            pass
+        keep, missing = file_closure(d, [ 'hello', 'etc/ssh/', 'tmux' ])
+        assert missing == { 'tmux' }
+        assert 'usr/bin/python3' in keep
+        assert 'etc/ssh/sshd_config' in keep
+        assert 'usr/bin/other' not in keep
+        for t, name in exe.dynamic():
+            if t == 1:
+                assert f'usr/lib64/{name}' in keep
+        # i.e. the default list keeps the top-level entries that boot needs
+        os.makedirs(d + '/dev')
+        os.symlink('usr/bin', d + '/bin')
+        os.symlink('usr/bin/hello', d + '/init')
+        keep, missing = file_closure(d, closure_files)
+        assert { '.', 'bin', 'dev', 'init', 'lib64', 'usr/bin/hello' } <= keep
+        sel = Tree_Selection(include=keep)
+        xs = [ x[0] for x in walk_tree(d, None, sel) ]
+        assert 'init' in xs and 'usr/bin/python3' in xs and 'usr/bin/other' not in xs
+        assert os.path.exists(d + '/usr/bin/other')
+
+def ssh_strings(b):
+    xs = []
+    while b:
+        n = int.from_bytes(b[:4], 'big')
+        xs.append(b[4:4+n])
+        b = b[4+n:]
+    return xs
+
+# same format as `ssh-keygen -l` prints
+def ssh_fingerprint(filename):
+    with open(filename) as f:
+        t, b, *c = f.read().split(maxsplit=2)
+    blob = base64.b64decode(b)
+    if t == 'ssh-rsa':
+        bits = int.from_bytes(ssh_strings(blob)[2], 'big').bit_length()
+    elif t.startswith('ecdsa-sha2-nistp'):
+        bits = int(t[16:])
+    else:
+        bits = 256
+    h = base64.b64encode(hashlib.sha256(blob).digest()).decode().rstrip('=')
+    name = { 'ssh-rsa': 'RSA', 'ssh-ed25519': 'ED25519' }.get(t, 'ECDSA')
+    comment = c[0].strip() if c else 'no comment'
+    return f'{bits} SHA256:{h} {comment} ({name})'
+
+def mk_host_config(destdir, keys, network=None):
+    check_public_keys(keys)
     os.makedirs(destdir + '/etc/ssh', exist_ok=True)
     for t in ('ecdsa', 'ed25519', 'rsa'):
         remove(f'{destdir}/etc/ssh/ssh_host_{t}_key')
         remove(f'{destdir}/etc/ssh/ssh_host_{t}_key.pub')
     subprocess.check_call(['ssh-keygen', '-A', '-f', destdir])
-    for t in ('ecdsa', 'ed25519', 'rsa'):
-        subprocess.check_call(['ssh-keygen', '-l',
-            '-f', f'{destdir}/etc/ssh/ssh_host_{t}_key'])
+    fps = [ ssh_fingerprint(f'{destdir}/etc/ssh/ssh_host_{t}_key.pub')
+            for t in ('ecdsa', 'ed25519', 'rsa') ]
     os.makedirs(destdir + '/root/.ssh', exist_ok=True)
     os.chmod(destdir + '/root', 0o700)
     os.chmod(destdir + '/root/.ssh', 0o700)
     shutil.copy(keys, destdir + '/root/.ssh/authorized_keys')
     os.chmod(destdir + '/root/.ssh/authorized_keys', 0o600)
+    if network:
+        os.makedirs(destdir + '/etc/systemd/network', exist_ok=True)
+        shutil.copy(network, destdir + '/etc/systemd/network/'
+                + os.path.basename(network))
+    return fps
 
-def mk_unpriv_cpio(destdir, compress, initramfs, l=6):
-    if compress == 'gz':
-        c = [ 'gzip' ]
-    elif compress == 'xz':
-        c = [ 'xz', f'-{l}', '--check=crc32' ]
-    else:
-        c = [ 'cat' ]
+@profiled
+def make_config(destdir, keys):
+    for fp in mk_host_config(destdir, keys):
+        print(fp)
+
+def compress_bytes(b, compress, l=None):
+    if compress == 'xz':
+        return lzma.compress(b, check=lzma.CHECK_CRC32,
+                preset=int(l or default_levels['xz']))
+    elif compress == 'gz':
+        return gzip.compress(b, int(l or default_levels['gz']), mtime=0)
+    elif compress:
+        return subprocess.run(compress_cmd(compress, l), input=b,
+                stdout=subprocess.PIPE, check=True).stdout
+    return b
+
+# i.e. the archive is built in memory and owned by root, as with gen_init_cpio
+def mk_host_config_cpio(destdir, keys, network, compress, initramfs, l=None):
+    fps = mk_host_config(destdir, keys, network)
+    b = io.BytesIO()
+    write_cpio(b, (e for e in walk_tree(destdir) if e[0] != '.'), owner=(0, 0))
+    with open(initramfs + '.tmp', 'wb') as f:
+        f.write(compress_bytes(b.getvalue(), compress, l))
+    os.rename(initramfs + '.tmp', initramfs)
+    return fps
+
+# The inventory is an INI file with one section per host, e.g.:
+#
+#     [DEFAULT]
+#     keys = /root/.ssh/authorized_keys
+#     [host1.example.org]
+#     network = host1.network
+#
+@profiled
+def make_fleet_config(args):
+    inv = configparser.ConfigParser(defaults={ 'keys': args.keys })
+    with open(args.fleet) as f:
+        inv.read_file(f)
+    base = os.path.dirname(args.initramfs)
+    suffix = f'{args.family}{args.release}.cpio.{args.compress}'
+    with concurrent.futures.ThreadPoolExecutor(args.jobs or None) as ex:
+        fs = [ (host, ex.submit(mk_host_config_cpio,
+                    f'{args.destdir}/{host}', inv[host]['keys'],
+                    inv[host].get('network'), args.compress,
+                    f'{base}/config-{host}-{suffix}', args.level))
+               for host in inv.sections() ]
+        with open(f'{base}/config-fingerprints.txt', 'w') as f:
+            for host, x in fs:
+                for fp in x.result():
+                    print(f'{host} {fp}', file=f)
+                print(f'Created {base}/config-{host}-{suffix}')
+
+def gen_init_cpio_line(relpath, filename, s, links=()):
+    mode = stat.S_IMODE(s.st_mode)
+    if stat.S_ISDIR(s.st_mode):
+        return f'dir /{relpath} {mode:04o} 0 0\n'
+    elif stat.S_ISLNK(s.st_mode):
+        return f'slink /{relpath} {os.readlink(filename)} {mode:04o} 0 0\n'
+    elif stat.S_ISCHR(s.st_mode) or stat.S_ISBLK(s.st_mode):
+        t = 'c' if stat.S_ISCHR(s.st_mode) else 'b'
+        return (f'nod /{relpath} {mode:04o} 0 0 {t}'
+                f' {os.major(s.st_rdev)} {os.minor(s.st_rdev)}\n')
+    elif stat.S_ISFIFO(s.st_mode):
+        return f'pipe /{relpath} {mode:04o} 0 0\n'
+    elif stat.S_ISSOCK(s.st_mode):
+        return f'sock /{relpath} {mode:04o} 0 0\n'
+    ls = ''.join(' /' + x for x in links)
+    return f'file /{relpath} {filename} {mode:04o} 0 0{ls}\n'
+
+def mk_unpriv_cpio(destdir, compress, initramfs, ex_paths=None, l=None, threads=0,
+        block_size=None, dedup=False, epoch=None, order='tree', selection=None,
+        usage=None):
+    # i.e. gen_init_cpio archives the real mtimes of files
+    if epoch is not None:
+        return mk_cpio(destdir, compress, initramfs, ex_paths, l, threads,
+                block_size, dedup, owner=(0, 0), epoch=epoch, order=order,
+                selection=selection, usage=usage)
+    c = compress_cmd(compress, l, threads, block_size) or [ 'cat' ]
+    entries = [ e for e in order_entries(walk_tree(destdir, ex_paths, selection),
+        order) if e[0] != '.' ]
+    groups = {}
+    if dedup:
+        for relpath, (k, n) in dedup_index(entries).items():
+            groups.setdefault(k, []).append(relpath)
+    links = { xs[0]: xs[1:] for xs in groups.values() }
+    skip = { x for xs in links.values() for x in xs }
+    if usage is not None:
+        for relpath, filename, s in entries:
+            data = ((stat.S_ISREG(s.st_mode) or stat.S_ISLNK(s.st_mode))
+                    and relpath not in skip)
+            usage.append((relpath, entry_memory(s, s.st_size if data else 0)))
     with open(initramfs, 'bw') as f:
         p = subprocess.Popen(['gen_init_cpio', '-'], stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE)
+                stdout=subprocess.PIPE, bufsize=1024*1024)
         q = subprocess.Popen(c, stdin=p.stdout, stdout=f)
-        for path, dns, fns in os.walk(destdir):
-            for x in dns:
-                filename = os.path.join(path, x)
-                relpath = path[len(destdir):] + '/' +  x
-                s = os.stat(filename)
-                p.stdin.write((f'dir {relpath} {stat.S_IMODE(s.st_mode):04o}'
-                        ' 0 0\n').encode())
-            for x in fns:
-                filename = os.path.join(path, x)
-                relpath = path[len(destdir):] + '/' +  x
-                s = os.stat(filename)
-                p.stdin.write((f'file {relpath} {filename}'
-                        f' {stat.S_IMODE(s.st_mode):04o} 0 0\n').encode())
+        p.stdout.close()
+        deferred = []
+        for relpath, filename, s in entries:
+            if relpath in skip:
+                continue
+            # i.e. when the parent directories of all links exist
+            if relpath in links:
+                deferred.append((relpath, filename, s))
+                continue
+            p.stdin.write(gen_init_cpio_line(relpath, filename, s)
+                    .encode(errors='surrogateescape'))
+        for relpath, filename, s in deferred:
+            p.stdin.write(gen_init_cpio_line(relpath, filename, s, links[relpath])
+                    .encode(errors='surrogateescape'))
         p.stdin.close()
         q.wait()
         if p.wait():
             raise RuntimeError(f'gen_init_cpio failed: {p.returncode}')
 
 
+# Files of the init shim for --layout squashfs/erofs, i.e. it mounts
+# the root image (with a tmpfs overlay) and switches to it.
+# (cf. closure_files)
+shim_files = [
+        '/bin', '/sbin', '/lib', '/lib64', '/dev', '/proc', '/sys', '/run',
+        'bash', 'cp', 'mkdir', 'modprobe', 'mount', 'switch_root',
+        'usr/lib/modules/*/modules.*',
+        ]
+
+shim_init = '''#!/usr/bin/bash
+# mounts the root image read-only with a tmpfs overlay, cf. mkrescuenet.py
+
+PATH=/usr/bin:/usr/sbin
+mount -t proc proc /proc
+mount -t sysfs sysfs /sys
+mount -t devtmpfs devtmpfs /dev
+mount -t tmpfs -o mode=0755 tmpfs /run
+for m in {modules}; do
+    modprobe -q $m
+done
+mkdir -p /run/rescue/lower /run/rescue/rw/upper /run/rescue/rw/work /sysroot
+mount -o loop,ro /{image} /run/rescue/lower
+mount -t overlay overlay -o lowerdir=/run/rescue/lower,upperdir=/run/rescue/rw/upper,workdir=/run/rescue/rw/work /sysroot
+# i.e. files of side loaded config archives
+for d in etc root; do
+    if [ -d /$d ]; then
+        cp -a /$d/. /sysroot/$d/
+    fi
+done
+exec switch_root /sysroot /usr/lib/systemd/systemd
+'''
+
+# i.e. the modules that the init shim loads for mounting the root image
+def layout_modules(layout):
+    return [ 'loop', layout, 'overlay' ]
+
+# Translates an ex_paths pattern into a regular expression for
+# mkfs.erofs --exclude-regex, i.e. wildcards don't match slashes.
+def glob_regex(pattern):
+    contents = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    r = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        j = pattern.find(']', i + 2) if c == '[' else -1
+        if c == '*':
+            r += '[^/]*'
+        elif c == '?':
+            r += '[^/]'
+        elif j != -1:
+            x = pattern[i+1:j]
+            r += '[' + ('^' + x[1:] if x.startswith('!') else x) + ']'
+            i = j
+        else:
+            r += re.escape(c)
+        i += 1
+    return '^' + r + ('/.+' if contents else '') + '$'
+
+def test_glob_regex():
+    r = re.compile(glob_regex('usr/share/locale/'))
+    assert r.match('usr/share/locale/de')
+    assert not r.match('usr/share/locale')
+    r = re.compile(glob_regex('usr/lib64/gconv/IBM*'))
+    assert r.match('usr/lib64/gconv/IBM1047.so')
+    assert not r.match('usr/lib64/gconv/IBM/x')
+    r = re.compile(glob_regex('var/log/dnf[!x].log'))
+    assert r.match('var/log/dnf1.log') and not r.match('var/log/dnfx.log')
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. EXDEV
+        shutil.copy2(src, dst, follow_symlinks=False)
+
+# Recreates the (selected) entries of a tree below dst, for tools that
+# just read directories (cf. mk_root_image()), i.e. regular files are
+# hardlinked and the tree itself isn't modified.
+def stage_tree(entries, dst):
+    entries = list(entries)
+    for relpath, filename, st in entries:
+        x = dst if relpath == '.' else f'{dst}/{relpath}'
+        if stat.S_ISDIR(st.st_mode):
+            os.makedirs(x, exist_ok=True)
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(filename), x)
+        elif stat.S_ISREG(st.st_mode):
+            link_or_copy(filename, x)
+        else:
+            try:
+                os.mknod(x, st.st_mode, st.st_rdev)
+            except PermissionError:
+                print(f'Skipping {relpath}: not permitted to create device nodes')
+                continue
+        if not os.getuid() and not stat.S_ISREG(st.st_mode):
+            os.lchown(x, st.st_uid, st.st_gid)
+    # i.e. after their contents are created
+    for relpath, filename, st in reversed(entries):
+        if stat.S_ISDIR(st.st_mode):
+            x = dst if relpath == '.' else f'{dst}/{relpath}'
+            os.chmod(x, stat.S_IMODE(st.st_mode))
+            os.utime(x, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def test_stage_tree():
+    with tempfile.TemporaryDirectory() as d:
+        for x in [ 'etc', 'usr/lib/modules/5.11.0/kernel' ]:
+            os.makedirs(f'{d}/t/{x}')
+        for x in [ 'etc/hostname', 'usr/lib/modules/5.11.0/modules.dep',
+                'usr/lib/modules/5.11.0/kernel/a.ko', 'usr/lib/modules/5.11.0/kernel/b.ko' ]:
+            with open(f'{d}/t/{x}', 'w') as f:
+                f.write(x)
+        os.symlink('../usr/lib', f'{d}/t/etc/lib')
+        with open(f'{d}/modules.dep', 'w') as f:
+            f.write('kernel/a.ko:\n')
+        os.chmod(f'{d}/t/etc', 0o750)
+        sel = Tree_Selection([ 'usr/lib/modules/5.11.0/kernel/b.ko' ], None,
+                { 'usr/lib/modules/5.11.0/modules.dep': f'{d}/modules.dep' })
+        stage_tree(walk_tree(f'{d}/t', [ 'etc/hostname' ], sel), f'{d}/s')
+        assert sorted(x[0] for x in walk_tree(f'{d}/s')) == [ '.', 'etc', 'etc/lib',
+                'usr', 'usr/lib', 'usr/lib/modules', 'usr/lib/modules/5.11.0',
+                'usr/lib/modules/5.11.0/kernel', 'usr/lib/modules/5.11.0/kernel/a.ko',
+                'usr/lib/modules/5.11.0/modules.dep' ]
+        with open(f'{d}/s/usr/lib/modules/5.11.0/modules.dep') as f:
+            assert f.read() == 'kernel/a.ko:\n'
+        assert os.readlink(f'{d}/s/etc/lib') == '../usr/lib'
+        assert stat.S_IMODE(os.stat(f'{d}/s/etc').st_mode) == 0o750
+        # i.e. the tree is untouched
+        assert os.path.exists(f'{d}/t/usr/lib/modules/5.11.0/kernel/b.ko')
+        sel = Tree_Selection(include={ '.', 'etc', 'etc/hostname' })
+        assert [ x[0] for x in walk_tree(f'{d}/t', None, sel) ] == [ '.', 'etc',
+                'etc/hostname' ]
+
+def mk_root_image(destdir, layout, compress, filename, ex_paths=None, threads=0,
+        epoch=None):
+    ex_paths = ex_paths or []
+    if layout == 'squashfs':
+        comp = { 'xz': [ '-comp', 'xz' ], 'gz': [ '-comp', 'gzip' ],
+                 'zst': [ '-comp', 'zstd' ], 'lz4': [ '-comp', 'lz4' ],
+                 '': [ '-noI', '-noD', '-noF', '-noX' ] }
+        if compress not in comp:
+            raise RuntimeError(f'Unsupported compression for squashfs: {compress}')
+        c = [ 'mksquashfs', destdir, filename, '-noappend', '-quiet' ] + comp[compress]
+        c += [ '-processors', str(threads or len(os.sched_getaffinity(0))),
+               '-wildcards' ]
+        for x in ex_paths:
+            c += [ '-e', x + '*' if x.endswith('/') else x ]
+        if os.getuid():
+            c.append('-all-root')
+        if epoch is not None:
+            c += [ '-mkfs-time', str(epoch), '-all-time', str(epoch) ]
+    elif layout == 'erofs':
+        comp = { 'xz': [ '-zlzma' ], 'gz': [ '-zdeflate' ], 'zst': [ '-zzstd' ],
+                 'lz4': [ '-zlz4hc' ], '': [] }
+        if compress not in comp:
+            raise RuntimeError(f'Unsupported compression for erofs: {compress}')
+        c = [ 'mkfs.erofs', '--quiet' ] + comp[compress]
+        c += [ f'--exclude-regex={glob_regex(x)}' for x in ex_paths ]
+        if os.getuid():
+            c.append('--all-root')
+        if epoch is not None:
+            c += [ f'-T{epoch}', '--all-time' ]
+        c += [ filename, destdir ]
+    else:
+        raise RuntimeError(f'Unknown layout: {layout}')
+    subprocess.check_call(c)
+
+# Appends an uncompressed archive to an image, where the kernel expects
+# each archive to start 4 byte aligned.
+# NB: the padding is flushed since Cpio_Writer writes to the fd directly
+def append_cpio(filename, entries, **kw):
+    with open(filename, 'ab') as f:
+        f.write(b'\0' * (-f.tell() & 3))
+        f.flush()
+        write_cpio(f, entries, **kw)
+
+def test_append_cpio():
+    with tempfile.TemporaryDirectory() as d:
+        with open(d + '/root.img', 'wb') as f:
+            f.write(b'hsqs' * 100)
+        with open(d + '/image', 'wb') as f:
+            f.write(b'xyz')
+        append_cpio(d + '/image', [ ('root.img', d + '/root.img',
+            os.lstat(d + '/root.img')) ], owner=(0, 0))
+        append_cpio(d + '/image', [ ('root.img', d + '/root.img',
+            os.lstat(d + '/root.img')) ], owner=(0, 0))
+        with open(d + '/image', 'rb') as f:
+            b = f.read()
+        assert b[:4] == b'xyz\0'
+        xs = [ m.start() for m in re.finditer(b'070701', b) ]
+        assert len(xs) == 4 and xs[0] == 4
+        assert all(x % 4 == 0 for x in xs)
+        # i.e. no padding is flushed after the trailer
+        assert b.rstrip(b'\0').endswith(b'TRAILER!!!') and len(b) % 4 == 0
+
+# Creates an image that consists of a (compressed) cpio archive with a
+# small init shim and an uncompressed one with the (compressed) root
+# image, i.e. at runtime, pages of the root image are decompressed on
+# demand instead of unpacking the complete tree into RAM.
+def mk_overlay_cpio(destdir, compress, initramfs, layout, ex_paths=None, l=None,
+        threads=0, block_size=None, dedup=False, epoch=None, order='tree',
+        selection=None, usage=None):
+    c = compress_cmd(compress, l, threads, block_size, epoch is not None)
+    owner = (0, 0) if os.getuid() else None
+    mods = []
+    for moddir in glob.glob(destdir + '/usr/lib/modules/*/modules.dep'):
+        moddir = os.path.dirname(moddir)
+        keep, deps = module_closure(moddir, layout_modules(layout))
+        mods.extend(os.path.relpath(f'{moddir}/{deps[x][0]}', destdir)
+                for x in keep)
+    keep, missing = file_closure(destdir, shim_files + mods)
+    if missing:
+        raise RuntimeError(f'Missing from the init shim: {", ".join(sorted(missing))}')
+    image = f'root.{layout}'
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(initramfs)) as d:
+        init = d + '/init'
+        with open(init, 'w') as f:
+            f.write(shim_init.format(image=image,
+                modules=' '.join(layout_modules(layout))))
+        os.chmod(init, 0o755)
+        overlay = selection.overlay if selection else {}
+        entries = []
+        for x in sorted(keep):
+            if x != 'init':
+                fn = overlay.get(x, f'{destdir}/{x}' if x != '.' else destdir)
+                entries.append((x, fn, os.lstat(fn)))
+        entries.append(('init', init, os.lstat(init)))
+        root, root_ex = destdir, ex_paths
+        if selection:
+            root, root_ex = d + '/root', None
+            stage_tree(walk_tree(destdir, ex_paths, selection), root)
+        mk_root_image(root, layout, compress, f'{d}/{image}', root_ex, threads,
+                epoch)
+        with open_compressed(initramfs, c) as out:
+            write_cpio(out, order_entries(entries, order), dedup, owner, epoch,
+                    usage=usage)
+        append_cpio(initramfs, [ (image, f'{d}/{image}', os.lstat(f'{d}/{image}')) ],
+                owner=(0, 0), epoch=epoch, usage=usage)
+
+
+# Optional features that are archived into separate segments (cf.
+# --features), i.e. the files of some packages and/or files matching
+# some patterns (as in ex_paths).
+feature_segments = {
+        'storage'  : { 'pkgs': [ 'btrfs-progs', 'dosfstools', 'fstransform',
+                                 'xfsprogs' ] },
+        'dev'      : { 'pkgs': [ 'git-core', 'ncdu' ] },
+        'firmware' : { 'paths': [ 'usr/lib/firmware/' ] },
+        }
+
+def feature_filename(initramfs, name):
+    d, base = os.path.split(initramfs)
+    stem, sep, ext = base.partition('.cpio')
+    return os.path.join(d, f'{stem}-{name}{sep}{ext}')
+
+# Assigns the non-directory entries to feature segments, everything
+# else stays in the base segment. Each feature segment also contains
+# the parent directories of its entries.
+# returns: { segment name (None for the base): [ entries ] }
+def split_features(entries, names, owners):
+    entries = list(entries)
+    tries = {}
+    pkgs  = {}
+    for name in names:
+        if name not in feature_segments:
+            raise RuntimeError(f'Unknown feature: {name}'
+                    f' (available: {", ".join(sorted(feature_segments))})')
+        f = feature_segments[name]
+        tries[name] = Exclude_Trie(f.get('paths', []))
+        pkgs.update((x, name) for x in f.get('pkgs', []))
+    segs    = { None: [] }
+    dirs    = {}
+    parents = {}
+    for e in entries:
+        relpath, _, st = e
+        if stat.S_ISDIR(st.st_mode):
+            dirs[relpath] = e
+            segs[None].append(e)
+            continue
+        name = pkgs.get(owners.get(relpath))
+        for k, t in tries.items():
+            if name:
+                break
+            ns = [ t ]
+            for x in relpath.split('/'):
+                exclude, contents, ns = trie_step(ns, x)
+                if exclude or contents:
+                    name = k
+                    break
+        if not name:
+            segs[None].append(e)
+            continue
+        xs = segs.setdefault(name, [])
+        have = parents.setdefault(name, set())
+        ps = []
+        p = relpath
+        while p != '.':
+            p = os.path.dirname(p) or '.'
+            if p in have:
+                break
+            have.add(p)
+            ps.append(p)
+        xs.extend(dirs[p] for p in reversed(ps) if p in dirs)
+        xs.append(e)
+    return segs
+
+def test_split_features():
+    st_dir = os.lstat('/')
+    with tempfile.NamedTemporaryFile() as f:
+        st_reg = os.lstat(f.name)
+    es = [ ('.', '/x', st_dir), ('usr', '/x/usr', st_dir),
+           ('usr/bin', '/x/usr/bin', st_dir), ('usr/bin/git', '/x/usr/bin/git', st_reg),
+           ('usr/bin/ls', '/x/usr/bin/ls', st_reg),
+           ('usr/lib', '/x/usr/lib', st_dir), ('usr/lib/firmware', '/x/usr/lib/firmware', st_dir),
+           ('usr/lib/firmware/a.fw', '/x/usr/lib/firmware/a.fw', st_reg) ]
+    segs = split_features(es, [ 'dev', 'firmware' ], { 'usr/bin/git': 'git-core' })
+    assert [ x[0] for x in segs[None] ] == [ '.', 'usr', 'usr/bin', 'usr/bin/ls',
+            'usr/lib', 'usr/lib/firmware' ]
+    assert [ x[0] for x in segs['dev'] ] == [ '.', 'usr', 'usr/bin', 'usr/bin/git' ]
+    assert [ x[0] for x in segs['firmware'] ] == [ '.', 'usr', 'usr/lib',
+            'usr/lib/firmware', 'usr/lib/firmware/a.fw' ]
+    assert feature_filename('f34.cpio.xz', 'dev') == 'f34-dev.cpio.xz'
+    assert feature_filename('/x/f34.cpio', 'dev') == '/x/f34-dev.cpio'
+
+# Creates the base image and one image per feature segment, i.e. the
+# images of the required features can be concatenated at boot.
+def mk_feature_cpios(destdir, compress, initramfs, features, ex_paths=None, l=None,
+        threads=0, block_size=None, dedup=False, epoch=None, order='tree',
+        selection=None, usage=None):
+    c = compress_cmd(compress, l, threads, block_size, epoch is not None)
+    owner = (0, 0) if os.getuid() else None
+    segs = split_features(walk_tree(destdir, ex_paths, selection), features,
+            rpm_file_owners(destdir))
+    for name in [ None ] + features:
+        fn = feature_filename(initramfs, name) if name else initramfs
+        with open_compressed(fn, c) as out:
+            write_cpio(out, order_entries(segs.get(name, []), order), dedup, owner,
+                    epoch, usage=usage)
+        print(f'Created {fn} ({fmt_size(os.path.getsize(fn))})')
+
+
+# Seekable images (cf. --seekable) consist of blocks that are compressed
+# independently (i.e. concatenated xz streams or zstd frames) and that
+# start at entry boundaries, which the kernel unpacks like any other
+# image. The sidecar index maps each path to its block, thus a single
+# file is extracted by just decompressing its block.
+seekable_block_size = 4 * 1024 * 1024
+
+def index_filename(image):
+    return image + '.index.json'
+
+def compress_block(b, compress, l):
+    if compress == 'xz':
+        # i.e. as the kernel's xz decoder requires it
+        return lzma.compress(b, check=lzma.CHECK_CRC32, preset=int(l))
+    return subprocess.run([ 'zstd', '-q', f'-{l}', '-c' ]
+            + ([ '--ultra' ] if int(l) > 19 else []), input=b,
+            stdout=subprocess.PIPE, check=True).stdout
+
+def decompress_block(b, compress):
+    if compress == 'xz':
+        return lzma.decompress(b)
+    return subprocess.run([ 'zstd', '-qdc' ], input=b, stdout=subprocess.PIPE,
+            check=True).stdout
+
+# Index: blocks as [ compressed offset, compressed size, uncompressed
+# offset, uncompressed size ] and files as path -> [ block, offset in
+# the uncompressed block, size, mode, rdev ]
+# NB: block_size (i.e. of multi-threaded xz) doesn't apply since each
+# block is compressed on its own, cf. seek_block_size
+def mk_seekable_cpio(destdir, compress, initramfs, seek_block_size=None,
+        ex_paths=None, l=None, threads=0, block_size=None, dedup=False, epoch=None,
+        order='tree', selection=None, usage=None):
+    if compress not in ('xz', 'zst'):
+        raise RuntimeError('--seekable requires xz or zstd compression')
+    l = l or default_levels[compress]
+    bs = parse_size(seek_block_size) if seek_block_size else seekable_block_size
+    index = []
+    owner = (0, 0) if os.getuid() else None
+    with tempfile.TemporaryFile(dir=os.path.dirname(initramfs)) as f:
+        write_cpio(f, order_entries(walk_tree(destdir, ex_paths, selection), order),
+                dedup, owner, epoch, index, usage)
+        n = f.tell()
+        starts = [ 0 ]
+        for _, start, *_ in index:
+            if start - starts[-1] >= bs:
+                starts.append(start)
+        ranges = list(zip(starts, starts[1:] + [ n ]))
+        fd = f.fileno()
+        def work(r):
+            return compress_block(os.pread(fd, r[1] - r[0], r[0]), compress, l)
+        blocks = []
+        with open(initramfs, 'wb') as out, concurrent.futures.ThreadPoolExecutor(
+                threads or len(os.sched_getaffinity(0))) as ex:
+            for (begin, end), b in zip(ranges, ex.map(work, ranges)):
+                blocks.append([ out.tell(), len(b), begin, end - begin ])
+                out.write(b)
+    files = {}
+    for name, _, mode, off, size, rdev in index:
+        i = bisect.bisect_right(starts, off) - 1
+        files[name] = [ i, off - starts[i], size, mode, rdev ]
+    with open(index_filename(initramfs), 'w') as f:
+        json.dump({ 'compress': compress, 'blocks': blocks, 'files': files }, f,
+                sort_keys=True)
+    print(f'Created {initramfs} with {len(blocks)} blocks')
+
+def read_index(image):
+    try:
+        with open(index_filename(image)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise RuntimeError(f'{image} has no index, i.e. it wasn\'t created'
+                ' with --seekable')
+
+def list_image(image):
+    idx = read_index(image)
+    for name, (_, _, size, mode, _) in sorted(idx['files'].items()):
+        print(f'{stat.filemode(mode)} {size:12} {name}')
+
+# Extracts the files that match one of the patterns (shell-style
+# wildcards) below outdir, where just the blocks that contain them are
+# read and decompressed.
+# Device nodes that can't be created (i.e. without privileges) are
+# skipped with a warning.
+@profiled
+def extract_image(image, patterns, outdir):
+    idx = read_index(image)
+    xs = [ (name, x) for name, x in sorted(idx['files'].items())
+            if any(fnmatch.fnmatchcase(name, p) for p in patterns) ]
+    if not xs:
+        raise RuntimeError(f'No file in {image} matches: {" ".join(patterns)}')
+    blocks = {}
+    with open(image, 'rb') as f:
+        for i in sorted(set(x[0] for _, x in xs)):
+            coff, csize, _, _ = idx['blocks'][i]
+            blocks[i] = decompress_block(os.pread(f.fileno(), csize, coff),
+                    idx['compress'])
+    dirs = []
+    skipped = 0
+    for name, (i, off, size, mode, rdev) in xs:
+        filename = os.path.join(outdir, name)
+        if stat.S_ISDIR(mode):
+            os.makedirs(filename, exist_ok=True)
+            dirs.append((filename, mode))
+            continue
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        remove(filename)
+        b = blocks[i][off:off+size]
+        if stat.S_ISLNK(mode):
+            os.symlink(os.fsdecode(b), filename)
+        elif stat.S_ISREG(mode):
+            with open(filename, 'wb') as g:
+                g.write(b)
+            os.chmod(filename, stat.S_IMODE(mode))
+        else:
+            try:
+                os.mknod(filename, mode, rdev)
+            except PermissionError:
+                print(f'Skipping {name}: not permitted to create device nodes',
+                        file=sys.stderr)
+                skipped += 1
+    # i.e. after their contents are extracted
+    for filename, mode in reversed(dirs):
+        os.chmod(filename, stat.S_IMODE(mode))
+    print(f'Extracted {len(xs) - skipped} entries from {len(blocks)} of'
+            f' {len(idx["blocks"])} blocks')
+
+def test_seekable():
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(d + '/t/etc/ssh')
+        with open(d + '/t/etc/ssh/sshd_config', 'w') as f:
+            f.write('PasswordAuthentication no\n')
+        with open(d + '/t/big', 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+        os.link(d + '/t/big', d + '/t/big2')
+        os.symlink('etc/ssh', d + '/t/ssh')
+        os.mkfifo(d + '/t/fifo')
+        os.chmod(d + '/t/etc/ssh', 0o700)
+        mk_seekable_cpio(d + '/t', 'xz', d + '/i.cpio.xz', '1k', l='1', epoch=0)
+        with io.BytesIO() as b:
+            write_cpio(b, walk_tree(d + '/t'), owner=(0, 0) if os.getuid() else None,
+                    epoch=0)
+            with open(d + '/i.cpio.xz', 'rb') as f:
+                # i.e. concatenated streams
+                assert lzma.decompress(f.read()) == b.getvalue()
+        idx = read_index(d + '/i.cpio.xz')
+        assert idx['files']['etc/ssh/sshd_config'][0] != idx['files']['big'][0]
+        assert idx['files']['big'][:3] == idx['files']['big2'][:3]
+        extract_image(d + '/i.cpio.xz', [ 'etc/ssh*', 'big', 'ssh', 'fifo' ], d + '/x')
+        assert stat.S_IMODE(os.stat(d + '/x/etc/ssh').st_mode) == 0o700
+        assert stat.S_ISFIFO(os.lstat(d + '/x/fifo').st_mode)
+        with open(d + '/x/etc/ssh/sshd_config') as f:
+            assert f.read() == 'PasswordAuthentication no\n'
+        with open(d + '/x/big', 'rb') as f, open(d + '/t/big', 'rb') as g:
+            assert f.read() == g.read()
+        assert os.readlink(d + '/x/ssh') == 'etc/ssh'
+
+
+def file_class(relpath, st, head=b''):
+    if stat.S_ISDIR(st.st_mode):
+        return 'dir'
+    if stat.S_ISLNK(st.st_mode):
+        return 'symlink'
+    if not stat.S_ISREG(st.st_mode):
+        return 'special'
+    name = relpath.rsplit('/', 1)[-1]
+    if '.ko' in name and re.search(r'\.ko(\.xz|\.zst|\.gz)?$', name):
+        return 'kmod'
+    if relpath.startswith('usr/lib/firmware/'):
+        return 'firmware'
+    if head.startswith(b'\x7fELF'):
+        if re.search(r'\.so(\.|$)', name):
+            return 'elf-so'
+        return 'elf-exec'
+    if name.endswith(('.py', '.pyc')):
+        return 'python'
+    if b'\0' in head:
+        return 'data'
+    return 'text'
+
+# rpm database of the installroot, i.e. relpath -> package name
+def rpm_file_owners(destdir):
+    try:
+        o = subprocess.check_output(['rpm', '--root', destdir, '-qa',
+            '--qf', '[%{NAME}\t%{FILENAMES}\n]'], text=True,
+            stderr=subprocess.DEVNULL)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return {}
+    d = {}
+    for line in o.splitlines():
+        pkg, _, fn = line.partition('\t')
+        d.setdefault(fn.lstrip('/'), pkg)
+    return d
+
+# The compressed contribution is estimated by compressing a sample of
+# each file with the raw LZMA2 filter, i.e. without any container
+# overhead.
+def estimate_compressed(filename, size, sample=256*1024):
+    with open(filename, 'rb') as f:
+        b = f.read(sample)
+    if not b:
+        return 0
+    k = len(lzma.compress(b, format=lzma.FORMAT_RAW,
+        filters=[ { 'id': lzma.FILTER_LZMA2, 'preset': 1 } ]))
+    return k * size // len(b)
+
+def analyze_tree(destdir, ex_paths=None, depth=3, selection=None):
+    owners = rpm_file_owners(destdir)
+    r = { 'destdir': destdir, 'total': [0, 0, 0],
+          'dirs': {}, 'pkgs': {}, 'types': {} }
+    def add(d, k, size, est):
+        x = d.setdefault(k, [0, 0, 0])
+        x[0] += size
+        x[1] += est
+        x[2] += 1
+    for relpath, filename, st in walk_tree(destdir, ex_paths, selection):
+        if relpath == '.':
+            continue
+        head = b''
+        size, est = 0, 0
+        if stat.S_ISREG(st.st_mode):
+            size = st.st_size
+            with open(filename, 'rb') as f:
+                head = f.read(512)
+            est = estimate_compressed(filename, size)
+        elif stat.S_ISLNK(st.st_mode):
+            size = est = len(os.readlink(filename))
+        d = '/'.join(relpath.split('/')[:-1][:depth]) or '.'
+        add(r['dirs'], d, size, est)
+        add(r['pkgs'], owners.get(relpath, '(none)') if owners else '(no rpmdb)',
+                size, est)
+        add(r['types'], file_class(relpath, st, head), size, est)
+        r['total'][0] += size
+        r['total'][1] += est
+        r['total'][2] += 1
+    return r
+
+def fmt_size(n):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(n) < 1024:
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n} B'
+        n /= 1024
+    return f'{n:.1f} GiB'
+
+def print_report(r, top=20):
+    size, est, n = r['total']
+    print(f'Total: {fmt_size(size)} uncompressed, ~{fmt_size(est)} compressed,'
+            f' {n} entries')
+    for k, title in (('dirs', 'Directory'), ('pkgs', 'Package'), ('types', 'Type')):
+        print(f'\n{title:40} {"Size":>12} {"~Compressed":>12} {"Entries":>8}')
+        xs = sorted(r[k].items(), key=lambda x: -x[1][0])
+        for name, (size, est, n) in xs[:top]:
+            print(f'{name:40} {fmt_size(size):>12} {fmt_size(est):>12} {n:8}')
+
+def print_report_diff(old, new, top=20):
+    size, est, n = new['total']
+    size0, est0, n0 = old['total']
+    print(f'Total: {fmt_size(size - size0):>12} uncompressed,'
+            f' ~{fmt_size(est - est0)} compressed, {n - n0:+} entries')
+    for k, title in (('dirs', 'Directory'), ('pkgs', 'Package'), ('types', 'Type')):
+        print(f'\n{title:40} {"+Size":>12} {"+~Compressed":>12} {"+Entries":>8}')
+        d = {}
+        for name in set(old[k]) | set(new[k]):
+            a = old[k].get(name, [0, 0, 0])
+            b = new[k].get(name, [0, 0, 0])
+            d[name] = [ y - x for x, y in zip(a, b) ]
+        xs = sorted(((name, x) for name, x in d.items() if any(x)),
+                key=lambda x: -abs(x[1][0]))
+        for name, (size, est, n) in xs[:top]:
+            print(f'{name:40} {fmt_size(size):>12} {fmt_size(est):>12} {n:+8}')
+
+# The kernel unpacks the initramfs into a tmpfs/ramfs, i.e. each file
+# occupies whole pages plus an inode and a dentry, while the compressed
+# image is still in memory.
+page_size      = 4096
+inode_overhead = 1024
+
+# i.e. what an entry occupies when unpacked, where size is the size of
+# its data in the archive (0 for all but one name of a hardlink group)
+def entry_memory(st, size):
+    if stat.S_ISLNK(st.st_mode) and size < 128:
+        size = 0 # i.e. stored inline in the inode
+    return inode_overhead + -(-size // page_size) * page_size
+
+# usage: (name, bytes) of each entry (cf. Cpio_Writer), where a name that
+#        is archived again (e.g. a parent directory of another segment)
+#        just counts once
+# returns: (total bytes, { directory: bytes })
+def boot_memory(usage, compressed, depth=3):
+    dirs  = {}
+    total = compressed
+    for relpath, k in dict(usage).items():
+        d = '/'.join(relpath.split('/')[:-1][:depth]) or '.'
+        dirs[d] = dirs.get(d, 0) + k
+        total += k
+    return total, dirs
+
+def parse_size(s):
+    units = { 'k': 1024, 'm': 1024**2, 'g': 1024**3 }
+    s = s.strip().lower().removesuffix('ib').removesuffix('b')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def test_boot_memory():
+    with tempfile.TemporaryDirectory() as d:
+        with open(d + '/a', 'wb') as f:
+            f.write(b'x' * 5000)
+        os.link(d + '/a', d + '/b')
+        os.symlink('a', d + '/c')
+        usage = []
+        write_cpio(io.BytesIO(), walk_tree(d), usage=usage)
+        total, dirs = boot_memory(usage, 100)
+        assert total == 100 + 4 * inode_overhead + 2 * page_size
+        assert dirs == { '.': total - 100 }
+        # i.e. the directories of other segments count once
+        total, dirs = boot_memory(usage + usage[:1], 100)
+        assert total == 100 + 4 * inode_overhead + 2 * page_size
+    assert parse_size('512M') == 512 * 1024**2
+    assert parse_size('1.5GiB') == 3 * 1024**3 // 2
+    assert parse_size('4096') == 4096
+
+# usage: as recorded while archiving (cf. Cpio_Writer), i.e. with
+#        --layout squashfs/erofs the root image is the largest entry
+@profiled
+def check_mem_budget(args, usage):
+    compressed = os.path.getsize(args.initramfs)
+    # i.e. with all feature segments
+    compressed += sum(os.path.getsize(feature_filename(args.initramfs, x))
+            for x in args.features)
+    total, dirs = boot_memory(usage, compressed, args.depth)
+    print(f'Boot memory: {fmt_size(total)} ({fmt_size(compressed)} compressed image,'
+            f' {fmt_size(total - compressed)} unpacked)')
+    if total > parse_size(args.mem_budget):
+        xs = sorted(dirs.items(), key=lambda x: -x[1])[:10]
+        ls = ''.join(f'\n    {fmt_size(n):>12}  {d}' for d, n in xs)
+        raise RuntimeError(f'Boot memory of {fmt_size(total)} exceeds --mem-budget'
+                f' {args.mem_budget}, largest contributors:{ls}')
+
+@profiled
+def analyze(args):
+    with tree_selection(args) as sel:
+        r = analyze_tree(args.destdir, args.ex_paths, args.depth, sel)
+    r['release'] = f'{args.family}{args.release}'
+    print_report(r)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(r, f, indent=1)
+    if args.diff:
+        with open(args.diff) as f:
+            old = json.load(f)
+        print(f'\nChanges since {old.get("release", args.diff)}:\n')
+        print_report_diff(old, r)
+
+
+# codec:level[:block size] configurations compared by --bench
+bench_configs = [ 'gz:1', 'gz:6', 'gz:9', 'xz:1', 'xz:6', 'xz:6:8MiB', 'xz:6:32MiB',
+        'xz:9', 'zst:3', 'zst:9', 'zst:19', 'lz4:1', 'lz4:9' ]
+
+def decompress_file(filename, compress):
+    if compress == 'xz':
+        with open(filename, 'rb') as f:
+            return len(lzma.decompress(f.read()))
+    elif compress == 'gz':
+        with open(filename, 'rb') as f:
+            return len(gzip.decompress(f.read()))
+    # i.e. there are no python modules for them in the standard library
+    c = { 'zst': [ 'zstd', '-qdc' ], 'lz4': [ 'lz4', '-qdc' ] }[compress]
+    return len(subprocess.check_output(c + [ filename ]))
+
+# NB: the ru_maxrss of a child also includes the RSS of its parent
+# before it exec'ed, thus the peak RSS (of the new process image) is
+# polled instead.
+def read_hwm(pid, name=None):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            d = dict(line.split(':', 1) for line in f)
+    except (FileNotFoundError, ProcessLookupError):
+        return 0
+    if (name and d['Name'].strip() != name[:15]) or 'VmHWM' not in d:
+        return 0
+    return int(d['VmHWM'].split()[0]) * 1024
+
+# returns: dict(size, wall, cpu, maxrss, dwall)
+def bench_config(cpio, out, compress, l, threads, block_size):
+    c = compress_cmd(compress, l, threads, block_size)
+    with open(cpio, 'rb') as f, open(out, 'wb') as g:
+        t = time.monotonic()
+        p = subprocess.Popen(c, stdin=f, stdout=g)
+        hwm = 0
+        while True:
+            pid, status, ru = os.wait4(p.pid, os.WNOHANG)
+            if pid:
+                break
+            hwm = max(hwm, read_hwm(p.pid, c[0]))
+            time.sleep(0.01)
+        wall = time.monotonic() - t
+        p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode:
+        raise RuntimeError(f'{shlex.join(c)} failed: {p.returncode}')
+    t = time.monotonic()
+    n = decompress_file(out, compress)
+    dwall = time.monotonic() - t
+    if n != os.path.getsize(cpio):
+        raise RuntimeError(f'{shlex.join(c)}: decompressed size mismatch')
+    return dict(size=os.path.getsize(out), wall=wall, cpu=ru.ru_utime + ru.ru_stime,
+            maxrss=hwm, dwall=dwall)
+
+def test_bench_config():
+    with tempfile.TemporaryDirectory() as d:
+        with open(d + '/image.cpio', 'wb') as f:
+            f.write(b'rescue' * 10000)
+        r = bench_config(d + '/image.cpio', d + '/image.cpio.gz', 'gz', '6', 1, None)
+        assert 0 < r['size'] < 60000
+        assert r['wall'] > 0 and r['dwall'] > 0
+
+# Compresses the (uncompressed) image of a tree with different
+# codecs/levels and recommends the one with the shortest transfer plus
+# decompression time that fits into the memory budget.
+@profiled
+def bench(args):
+    configs = args.bench_configs.split(',') if args.bench_configs else bench_configs
+    bandwidth = parse_size(args.bandwidth)
+    with tree_selection(args) as sel, tempfile.TemporaryDirectory(
+            dir=os.path.dirname(args.initramfs)) as d:
+        entries = list(walk_tree(args.destdir, args.ex_paths, sel))
+        rs = []
+        # i.e. the type order is checked against the tree order
+        for order in ('tree', 'type'):
+            cpio = d + '/image.cpio'
+            usage = []
+            with open(cpio, 'wb') as f:
+                write_cpio(f, order_entries(entries, order), args.dedup,
+                        (0, 0) if os.getuid() else None, usage=usage)
+            # i.e. the unpacked files don't depend on the codec
+            footprint, _ = boot_memory(usage, 0)
+            n = os.path.getsize(cpio)
+            print(f'\nUncompressed: {fmt_size(n)}, --order {order}\n')
+            print(f'{"Config":14} {"Size":>11} {"Ratio":>6} {"Wall":>8} {"CPU":>8}'
+                    f' {"MaxRSS":>11} {"Unpack":>11} {"Boot mem":>11} {"Xfer+unp":>9}')
+            for x in configs:
+                compress, l, *bs = x.split(':')
+                r = bench_config(cpio, f'{d}/image.cpio.{compress}', compress, l,
+                        args.threads, bs[0] if bs else None)
+                r['config'] = x
+                r['order'] = order
+                r['mem'] = footprint + r['size']
+                r['score'] = r['size'] / bandwidth + r['dwall']
+                rs.append(r)
+                print(f'{x:14} {fmt_size(r["size"]):>11} {n / r["size"]:6.2f}'
+                        f' {r["wall"]:7.2f}s {r["cpu"]:7.2f}s {fmt_size(r["maxrss"]):>11}'
+                        f' {fmt_size(n / max(r["dwall"], 1e-6)):>9}/s'
+                        f' {fmt_size(r["mem"]):>11} {r["score"]:8.2f}s')
+    budget = parse_size(args.mem_budget) if args.mem_budget else None
+    xs = [ r for r in rs if budget is None or r['mem'] <= budget ]
+    if not xs:
+        print(f'\nNo configuration fits into --mem-budget {args.mem_budget}')
+        return
+    r = min(xs, key=lambda r: r['score'])
+    compress, l, *bs = r['config'].split(':')
+    flags = { 'gz': '--gz', 'xz': '', 'zst': '--zstd', 'lz4': '--lz4' }
+    opts = ' '.join(x for x in (flags[compress], f'--level {l}',
+        f'--block-size {bs[0]}' if bs else '',
+        f'--order {r["order"]}' if r['order'] != 'tree' else '') if x)
+    print(f'\nRecommended for {fmt_size(bandwidth)}/s'
+            f'{f" and {args.mem_budget} RAM" if budget else ""}: {opts}')
+
+
 mini_dotfiles = {
         '.vimrc': '''set incsearch
 set hlsearch
@@ -374,31 +3108,92 @@ set blink-matching-paren on
 ''',
 }
 
+@profiled
 def write_mini_dotfiles(destdir):
     for k, v in mini_dotfiles.items():
+        remove(f'{destdir}/root/{k}')
         with open(f'{destdir}/root/{k}', 'w') as f:
             f.write(v)
 
 
-def main():
-    args = parse_args()
-    if args.print_pkgs:
-        print('\n'.join(minimal_pkgs))
-        return
-    if args.make:
-        mk_cpio(args.destdir, args.compress, args.initramfs, ex_paths, l=args.level)
-        return
-    if args.make_config:
-        make_config(args.destdir, args.keys)
-        if os.getuid():
-            mk_unpriv_cpio(args.destdir, args.compress, args.initramfs, l=args.level)
-        else:
-            mk_cpio(args.destdir, args.compress, args.initramfs, l=args.level)
-        return
+# Selects what is archived (cf. --hw-profile, --no-prune-firmware,
+# --closure), i.e. without modifying the tree, such that it can be
+# archived differently by other builds. Generated files are written
+# below stage_dir.
+def select_tree(args, stage_dir):
+    exclude = set()
+    overlay = {}
+    if args.hw_profile:
+        names = profile_modules(args.hw_profile.split(','),
+                args.modules.split(',') if args.modules else ())
+        if args.layout != 'cpio':
+            names += layout_modules(args.layout)
+        exclude, overlay = select_modules(args.destdir, names, stage_dir)
+    if args.prune_firmware:
+        exclude |= select_firmware(args.destdir, args.keep_firmware, exclude)
+    include = None
+    if args.closure:
+        include = select_closure(args.destdir, args.closure_files)
+    return Tree_Selection(exclude, include, overlay)
+
+@contextlib.contextmanager
+def tree_selection(args):
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(args.initramfs)) as d:
+        yield select_tree(args, d)
+
+def cpio_opts(args):
+    return dict(l=args.level, threads=args.threads, block_size=args.block_size,
+            dedup=args.dedup, epoch=args.epoch, order=args.order)
+
+# i.e. in sha256sum format
+def print_digest(filename):
+    h = file_digest(filename, bytearray(1024 * 1024)).hex()
+    print(f'{h}  {os.path.basename(filename)}')
+
+@profiled
+def mk_image(args):
+    copts = cpio_opts(args)
+    # i.e. the boot memory is estimated from what is archived
+    usage = [] if args.mem_budget else None
+    with tree_selection(args) as sel:
+        copts['selection'] = sel
+        copts['usage'] = usage
+        with compress_slots or contextlib.nullcontext():
+            if args.seekable:
+                mk_seekable_cpio(args.destdir, args.compress, args.initramfs,
+                        args.seekable_block_size, args.ex_paths, **copts)
+            elif args.features:
+                mk_feature_cpios(args.destdir, args.compress, args.initramfs,
+                        args.features, args.ex_paths, **copts)
+            elif args.layout != 'cpio':
+                mk_overlay_cpio(args.destdir, args.compress, args.initramfs,
+                        args.layout, args.ex_paths, **copts)
+            elif args.cache:
+                mk_cached_cpio(args.destdir, args.compress, args.initramfs,
+                        os.path.abspath(args.cache), args.ex_paths,
+                        owner=(0, 0) if os.getuid() else None, **copts)
+            elif os.getuid():
+                mk_unpriv_cpio(args.destdir, args.compress, args.initramfs,
+                        args.ex_paths, **copts)
+            else:
+                mk_cpio(args.destdir, args.compress, args.initramfs, args.ex_paths,
+                        **copts)
+    if args.reproducible:
+        print_digest(args.initramfs)
+    if args.mem_budget:
+        check_mem_budget(args, usage)
+
 
-    if args.install:
-        install_pkgs(args.destdir, args.release)
-    compress_licenses(args.destdir, l=args.level)
+# NB: the license archive is always compressed with the default level,
+# i.e. builds with different compression options can share a tree
+def prepare_tree(args):
+    if args.base_cache:
+        base = mk_base_tree(args.base_cache, args.family, args.release, args.pkgs,
+                args.pkg_cache)
+        clone_tree(base, args.destdir)
+    elif args.install:
+        install_pkgs(args.destdir, args.release, args.pkgs, args.pkg_cache)
+    compress_licenses(args.destdir)
     add_default_nw_config(args.destdir, args.network)
     disable_ssh_pw_auth(args.destdir)
     config_selinux(args.destdir, args.selinux)
@@ -408,9 +3203,179 @@ def main():
     enable_init(args.destdir)
     set_password(args.destdir, args.password, args.salt)
     write_mini_dotfiles(args.destdir)
+    if args.debloat:
+        debloat(args.destdir, args.debloat)
+
+def build(args):
+    if args.print_pkgs:
+        print('\n'.join(args.pkgs))
+        return
+    if args.list_image:
+        list_image(args.list_image)
+        return
+    if args.extract_image:
+        extract_image(args.extract_image, args.extract_paths or [ '*' ],
+                args.extract_dir)
+        return
+    if args.analyze:
+        analyze(args)
+        return
+    if args.bench:
+        bench(args)
+        return
+    if args.make:
+        mk_image(args)
+        return
+    if args.make_config and args.fleet:
+        make_fleet_config(args)
+        return
+    if args.make_config:
+        make_config(args.destdir, args.keys)
+        copts = cpio_opts(args)
+        if os.getuid():
+            mk_unpriv_cpio(args.destdir, args.compress, args.initramfs, **copts)
+        else:
+            mk_cpio(args.destdir, args.compress, args.initramfs, **copts)
+        if args.reproducible:
+            print_digest(args.initramfs)
+        return
 
-    mk_cpio(args.destdir, args.compress, args.initramfs, ex_paths, l=args.level)
+    prepare_tree(args)
+    mk_image(args)
     cp_kernel(args.destdir, args.vmlinuz)
 
+
+def init_matrix_worker(installs, compressions):
+    global install_slots, compress_slots
+    install_slots  = installs
+    compress_slots = compressions
+
+# NB: the phases of a job are returned to the parent (cf. --profile),
+# where a worker process may run several jobs
+def matrix_tree_job(argv):
+    phases.clear()
+    args = parse_args(argv)
+    if not args.make:
+        prepare_tree(args)
+    return phases
+
+def matrix_image_job(argv):
+    phases.clear()
+    args = parse_args(argv)
+    mk_image(args)
+    if not args.make:
+        cp_kernel(args.destdir, args.vmlinuz)
+    return args.initramfs, phases
+
+# i.e. the options that prepare_tree() applies, whereas the others
+# (e.g. --hw-profile or --closure) just select what is archived
+def tree_options(args):
+    return { 'family': args.family, 'release': args.release,
+             'install': args.install, 'base-cache': args.base_cache,
+             'packages': args.pkgs, 'network': args.network,
+             'password': args.password, 'salt': args.salt,
+             'selinux': args.selinux, 'debloat': args.debloat, 'make': args.make }
+
+# returns: { destdir: [ jobs ] }
+def matrix_trees(jobs):
+    trees = {}
+    for job in jobs:
+        args = parse_args(job)
+        opts = tree_options(args)
+        if args.destdir not in trees:
+            trees[args.destdir] = (opts, [])
+        xs = [ k for k, v in trees[args.destdir][0].items() if opts[k] != v ]
+        if xs:
+            raise RuntimeError(f'Matrix builds for {args.destdir} differ in options'
+                    f' that affect the tree ({", ".join(xs)}): {shlex.join(job)}')
+        trees[args.destdir][1].append(job)
+    return { k: js for k, (_, js) in trees.items() }
+
+def test_matrix_trees():
+    ts = matrix_trees([ [ '-d', 'a', '--hw-profile', 'virtio' ], [ '-d', 'a', '--zstd',
+        '--closure' ], [ '-d', 'b', '--no-network' ] ])
+    assert [ len(js) for js in ts.values() ] == [ 2, 1 ]
+    try:
+        matrix_trees([ [ '-d', 'a' ], [ '-d', 'a', '--no-network', '--debloat' ] ])
+        assert False
+    except RuntimeError as e:
+        assert '(network, debloat)' in str(e)
+    try:
+        matrix_trees([ [ '-d', 'w', '--release', '33' ], [ '-d', 'w', '--release', '34' ] ])
+        assert False
+    except RuntimeError as e:
+        assert '(release)' in str(e)
+
+def strip_opts(argv, names):
+    r = []
+    skip = False
+    for x in argv:
+        if skip:
+            skip = False
+        elif x in names:
+            skip = True
+        elif not x.partition('=')[0] in names:
+            r.append(x)
+    return r
+
+def test_strip_opts():
+    assert strip_opts([ '--matrix', 'm', '--jobs=2', '--pw', 'pw' ],
+            ('--matrix', '--jobs')) == [ '--pw', 'pw' ]
+
+# Each line of the matrix file contains the options of one build which
+# are appended to the remaining command line options.
+# Builds that share a destination directory (i.e. family/release) must
+# only differ in how the image is created (cf. tree_options()), thus the
+# tree is just prepared once.
+def build_matrix(args, argv):
+    base = strip_opts(argv, ('--matrix', '--jobs', '-j', '--max-installs',
+        '--max-compress'))
+    if not args.pkg_cache:
+        base.append(f'--pkg-cache={os.path.abspath("dnf-cache")}')
+    with open(args.matrix) as f:
+        jobs = [ base + shlex.split(line) for line in f
+                if line.strip() and not line.startswith('#') ]
+    trees = matrix_trees(jobs)
+    ctx = multiprocessing.get_context('fork')
+    slots = (ctx.BoundedSemaphore(args.max_installs),
+             ctx.BoundedSemaphore(args.max_compress))
+    errors = []
+    with concurrent.futures.ProcessPoolExecutor(args.jobs or len(jobs),
+            mp_context=ctx, initializer=init_matrix_worker,
+            initargs=slots) as ex:
+        tfs = { ex.submit(matrix_tree_job, js[0]): js for js in trees.values() }
+        ifs = {}
+        for t in concurrent.futures.as_completed(tfs):
+            if t.exception():
+                errors.append((tfs[t][0], t.exception()))
+                continue
+            phases.extend(t.result())
+            for job in tfs[t]:
+                ifs[ex.submit(matrix_image_job, job)] = job
+        for i in concurrent.futures.as_completed(ifs):
+            if i.exception():
+                errors.append((ifs[i], i.exception()))
+            else:
+                initramfs, ps = i.result()
+                phases.extend(ps)
+                print(f'Created {initramfs}')
+    for job, e in errors:
+        print(f'Failed: {shlex.join(job)}: {e}', file=sys.stderr)
+    if errors:
+        raise RuntimeError(f'{len(errors)} of {len(jobs)} matrix builds failed')
+
+def main():
+    args = parse_args()
+    try:
+        if args.matrix:
+            build_matrix(args, sys.argv[1:])
+        else:
+            build(args)
+    finally:
+        if args.profile:
+            write_profile(args.profile)
+        if args.trace:
+            write_profile(args.trace, trace=True)
+
 if __name__ == '__main__':
     sys.exit(main())